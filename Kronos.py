@@ -1,6 +1,13 @@
+import time
+start_time = time.time()
+
 import argparse
-from listener import Listener
-from intent_handler import IntentHandler
+import os
+from listener import Listener, load_models
+from intent_handler import IntentHandler, get_timer_scheduler, RESPONSE_TEMPLATES
+from metrics import Metrics
+from inference_optimization import configure_threads
+from model_cache import ModelCache, DEFAULT_CACHE_DIR
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Kronos virtual assistant")
@@ -17,17 +24,100 @@ if __name__ == "__main__":
         help="path to the wave file to play upon waking up")
     parser.add_argument("-uvs", "--use_voice_synthesis", action="store_true",
         help="whether or not to use the voice_synthesis.py to synthesize responses")
+    parser.add_argument("-vh", "--vad_hangover", type=float, default=.5,
+        help="seconds of silence after which a voice command is considered finished")
+    parser.add_argument("-mcd", "--max_command_duration", type=float, default=4,
+        help="maximum length of a voice command in seconds")
+    parser.add_argument("-sr", "--streaming_recognition", action="store_true",
+        help="whether or not to run the speech recognition on the voice command "
+             "while it's still being recorded")
+    parser.add_argument("-mdi", "--metrics_dump_interval", type=float, default=0,
+        help="if given, print the timings and counters of the pipeline every "
+             "this many seconds")
+    parser.add_argument("-mp", "--metrics_port", type=int, default=0,
+        help="if given, serve the timings and counters of the pipeline on "
+             "http://127.0.0.1:<port>/metrics")
+    parser.add_argument("-q", "--quantize", action="store_true",
+        help="whether or not to quantize the models to int8 for faster CPU inference")
+    parser.add_argument("-js", "--script", action="store_true",
+        help="whether or not to script and freeze the models with TorchScript")
+    parser.add_argument("-nt", "--num_threads", type=int, default=0,
+        help="number of threads torch is allowed to use, defaults to all cores")
+    parser.add_argument("-it", "--intent_timeout", type=float, default=15,
+        help="seconds after which we give up on handling an intent")
+    parser.add_argument("-id", "--input_devices", type=int, nargs="+",
+        help="indices of the input devices to listen to, e.g. one per room, "
+             "sharing the same models")
+    parser.add_argument("-od", "--output_devices", type=int, nargs="+",
+        help="indices of the output devices to respond through, one per input device")
+    parser.add_argument("-cd", "--cache_dir", default=DEFAULT_CACHE_DIR,
+        help="directory to cache the prepared models in, so later starts are faster")
+    parser.add_argument("-nc", "--no_cache", action="store_true",
+        help="whether or not to skip caching the prepared models and synthesized speech")
+    parser.add_argument("-scs", "--speech_cache_size", type=float, default=64,
+        help="maximum size of the synthesized speech cache in megabytes")
 
     parsed_args = parser.parse_args()
 
+    metrics = Metrics(enabled=bool(
+        parsed_args.metrics_dump_interval or parsed_args.metrics_port))
+    if parsed_args.metrics_dump_interval:
+        metrics.start_periodic_dump(parsed_args.metrics_dump_interval)
+    if parsed_args.metrics_port:
+        metrics.start_server(parsed_args.metrics_port)
+
+    if parsed_args.num_threads:
+        configure_threads(parsed_args.num_threads)
+
+    models = load_models(parsed_args.trained_wake_word_model_path,
+        parsed_args.trained_speech_recognition_model_path,
+        parsed_args.trained_joint_intent_and_slot_model_path,
+        parsed_args.language_model_path,
+        quantize=parsed_args.quantize, script=parsed_args.script,
+        model_cache=None if parsed_args.no_cache else ModelCache(parsed_args.cache_dir))
+
     synthesize_func = None
     if parsed_args.use_voice_synthesis:
         import voice_synthesizer
         synthesize_func = voice_synthesizer.synthesize
 
-    Listener(parsed_args.trained_wake_word_model_path,
+        if not parsed_args.no_cache:
+            from speech_cache import SpeechCache
+            speech_cache = SpeechCache(os.path.join(parsed_args.cache_dir, "speech"),
+                int(parsed_args.speech_cache_size * 2 ** 20))
+            speech_cache.add_templates(RESPONSE_TEMPLATES)
+            voice_synthesizer.set_speech_cache(speech_cache)
+
+    listener_class = Listener
+    listener_kwargs = {}
+    if parsed_args.input_devices:
+        # Serve all the input devices from this one process
+        from multi_stream_listener import MultiStreamListener
+        output_devices = parsed_args.output_devices or []
+        if len(output_devices) not in [0, len(parsed_args.input_devices)]:
+            parser.error("There needs to be an output device per input device")
+
+        listener_class = MultiStreamListener
+        listener_kwargs["streams"] = [{"name": "input %i" % input_device,
+                "input_device_index": input_device,
+                "output_device_index": output_devices[i] if output_devices else None}
+            for i, input_device in enumerate(parsed_args.input_devices)]
+
+    listener = listener_class(parsed_args.trained_wake_word_model_path,
         parsed_args.trained_speech_recognition_model_path,
         parsed_args.trained_joint_intent_and_slot_model_path,
         parsed_args.language_model_path,
         parsed_args.wake_notification_wav_path,
-        IntentHandler(), synthesize_func).start()
+        IntentHandler(), synthesize_func,
+        vad_hangover=parsed_args.vad_hangover,
+        max_command_duration=parsed_args.max_command_duration,
+        streaming_recognition=parsed_args.streaming_recognition,
+        metrics=metrics, models=models,
+        intent_timeout=parsed_args.intent_timeout,
+        **listener_kwargs)
+
+    # Resume any timers that were still pending when we were last shut down
+    get_timer_scheduler()
+
+    print("Kronos is ready to wake up, after %.2fs" % (time.time() - start_time))
+    listener.start()
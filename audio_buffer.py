@@ -0,0 +1,69 @@
+import torch
+
+
+class RingBuffer(object):
+    # A fixed capacity circular buffer of audio samples, backed by a single
+    # preallocated tensor, so appending chunks never allocates.
+    #
+    # The storage is twice the capacity and every sample is written twice - once
+    # at its position and once at its position + capacity. That way the most
+    # recent N samples are always laid out contiguously somewhere in the storage
+    # and we can hand them out as a view, rather than copying them into a new
+    # tensor every time.
+    def __init__(self, capacity, dtype=torch.float32):
+        self.capacity = capacity
+        self._storage = torch.zeros(capacity * 2, dtype=dtype)
+        self._write_index = 0
+        self._length = 0
+        self._total_samples = 0
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def total_samples(self):
+        # The number of samples written since the buffer was last cleared,
+        # including the ones that have since been overwritten
+        return self._total_samples
+
+    def is_full(self):
+        return self._length == self.capacity
+
+    def clear(self):
+        self._write_index = 0
+        self._length = 0
+        self._total_samples = 0
+
+    def extend(self, samples):
+        self._total_samples += samples.shape[0]
+
+        # Anything older than the capacity would be overwritten anyway
+        samples = samples[-self.capacity:]
+        num_samples = samples.shape[0]
+
+        # Write up to the end of the first half of the storage and wrap the rest
+        # around to the beginning
+        head = min(num_samples, self.capacity - self._write_index)
+        tail = num_samples - head
+
+        start = self._write_index
+        self._storage[start:start + head] = samples[:head]
+        self._storage[start + self.capacity:start + self.capacity + head] = samples[:head]
+
+        if tail:
+            self._storage[:tail] = samples[head:]
+            self._storage[self.capacity:self.capacity + tail] = samples[head:]
+
+        self._write_index = (self._write_index + num_samples) % self.capacity
+        self._length = min(self._length + num_samples, self.capacity)
+
+    def latest(self, num_samples=None):
+        # Returns a view of the last `num_samples` samples in chronological order.
+        # NOTE: The view shares memory with the buffer, so it's only valid until
+        # the next call to `extend`, and writing to it only writes to one of the
+        # two copies of each sample.
+        if num_samples is None or num_samples > self._length:
+            num_samples = self._length
+
+        end = self._write_index + self.capacity
+        return self._storage[end - num_samples:end]
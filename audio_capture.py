@@ -0,0 +1,124 @@
+import queue
+import threading
+
+
+# The error number of pyaudio.paInputOverflowed, so we don't need to import
+# pyaudio to tell an overflow apart from the stream actually failing
+PA_INPUT_OVERFLOWED = -9981
+
+
+class AudioCapture(object):
+    # Reads chunks from an input stream on its own thread and puts them on a
+    # bounded queue, so the mic keeps getting read while the listener is busy
+    # running the models or handling an intent.
+    #
+    # If the consumer falls so far behind that the queue fills up, we drop the
+    # oldest chunk rather than block, as it's more useful to catch up with what's
+    # being said now than to process stale audio.
+    #
+    # Any other error reading from the stream is retried with an increasing
+    # delay, up to `max_consecutive_errors` times in a row, after which we stop
+    # capturing, as the device has most likely gone away.
+    def __init__(self, stream, chunk_size=4000, max_queued_chunks=20,
+            max_consecutive_errors=10, max_retry_delay=1.):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=max_queued_chunks)
+
+        # Counters, so we can tell when inference is not keeping up with real time
+        # - overflow_count - number of times the input stream overflowed, meaning
+        #   the device had audio we didn't read in time
+        # - dropped_chunk_count - number of chunks we captured, but had to throw
+        #   away, because the queue was full
+        # - error_count - number of reads that failed for any other reason
+        self.captured_chunk_count = 0
+        self.overflow_count = 0
+        self.dropped_chunk_count = 0
+        self.error_count = 0
+
+        self.max_consecutive_errors = max_consecutive_errors
+        self.max_retry_delay = max_retry_delay
+
+        # Set every time a chunk is queued, if given, so a consumer of several
+        # captures can wait on all of them at once
+        self.ready_event = None
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def read(self, timeout=None):
+        # Returns the next chunk or None if nothing was captured within the timeout
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self):
+        # Returns all the chunks that are queued right now, without waiting
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.queue.get_nowait())
+            except queue.Empty:
+                return chunks
+
+    def _put(self, chunk):
+        while True:
+            try:
+                self.queue.put_nowait(chunk)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped_chunk_count += 1
+                except queue.Empty:
+                    pass
+
+    def _capture(self):
+        consecutive_errors = 0
+        while not self._stop_event.is_set():
+            try:
+                chunk = bytearray(self.stream.read(self.chunk_size))
+            except IOError as e:
+                if e.errno == PA_INPUT_OVERFLOWED:
+                    # The audio of this read is lost, but the stream is still
+                    # usable, so we carry on straight away
+                    self.overflow_count += 1
+                    print("Error in AudioCapture: The input stream overflowed "
+                          "(%i overflows so far)" % self.overflow_count)
+                    continue
+
+                self.error_count += 1
+                consecutive_errors += 1
+                if consecutive_errors >= self.max_consecutive_errors:
+                    print("Error in AudioCapture: Failed reading from the input "
+                          "stream %i times in a row, stopping - " % consecutive_errors, e)
+                    return
+
+                print("Error in AudioCapture: Failed reading from the input stream - ", e)
+                self._stop_event.wait(
+                    min(.05 * 2 ** (consecutive_errors - 1), self.max_retry_delay))
+                continue
+
+            consecutive_errors = 0
+            self.captured_chunk_count += 1
+            self._put(chunk)
+            if self.ready_event is not None:
+                self.ready_event.set()
@@ -0,0 +1,264 @@
+import collections
+import threading
+import wave
+import torch
+
+
+# A single output engine for everything Kronos plays - the wake notification,
+# the timer alarms and the synthesized speech.
+#
+# It owns one long lived pyaudio output stream, which pulls its audio through
+# a callback, so playing a sound only adds it to the list of sounds being
+# mixed and returns straight away, rather than blocking until it's finished.
+#
+# Everything is converted to the engine's format (float32 samples at a fixed
+# rate and number of channels) up front, and clips played from files are only
+# decoded once and kept in memory.
+#
+# Usage:
+#   audio_output = get_audio_output()
+#   audio_output.play("data/timer.wav")
+#
+#   # or for audio that's still coming in
+#   sound = audio_output.open_sound()
+#   sound.feed(audio_output.to_samples(frames, sample_width, channels, frame_rate))
+#   sound.close()
+#   sound.wait()
+
+# Synthesized speech comes in at 22050Hz, so we play everything at that rate,
+# to avoid resampling the speech as it streams in
+DEFAULT_FRAME_RATE = 22050
+DEFAULT_CHANNELS = 1
+DEFAULT_FRAMES_PER_BUFFER = 512
+
+# pyaudio and the engines are shared by everything in the process and only
+# created the first time they're needed. There's one engine per output device,
+# keyed by the device index, with None being the default device.
+_pyaudio = None
+_audio_outputs = {}
+_lock = threading.Lock()
+
+def get_pyaudio():
+    global _pyaudio
+    with _lock:
+        if _pyaudio is None:
+            import pyaudio
+            _pyaudio = pyaudio.PyAudio()
+    return _pyaudio
+
+def get_audio_output(output_device_index=None):
+    with _lock:
+        if output_device_index not in _audio_outputs:
+            _audio_outputs[output_device_index] = AudioOutput(
+                output_device_index=output_device_index)
+        return _audio_outputs[output_device_index]
+
+def shutdown():
+    global _pyaudio
+    with _lock:
+        for audio_output in _audio_outputs.values():
+            audio_output.close()
+        _audio_outputs.clear()
+        if _pyaudio is not None:
+            _pyaudio.terminate()
+            _pyaudio = None
+
+
+class Sound(object):
+    # A sound that's being played, made of one or more (frames, channels)
+    # tensors. Sounds that are still coming in are fed more samples as they
+    # arrive and closed once there won't be any more.
+    #
+    # The sound is mixed on the audio thread, while it's fed or stopped from
+    # others (e.g. the stop word cancelling a response), so all of them hold
+    # the sound's lock. An exception on the audio thread would abort the shared
+    # output stream.
+    def __init__(self, samples=None):
+        self._chunks = collections.deque()
+        self._position = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self.finished = threading.Event()
+
+        if samples is not None:
+            self.feed(samples)
+            self.close()
+
+    def feed(self, samples):
+        if samples.shape[0]:
+            with self._lock:
+                if not self.finished.is_set():
+                    self._chunks.append(samples)
+
+    def close(self):
+        self._closed = True
+
+    def stop(self):
+        with self._lock:
+            self._chunks.clear()
+            self._position = 0
+            self._closed = True
+            self.finished.set()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def mix_into(self, out):
+        # Adds up to len(out) frames to `out`. Called on the audio thread.
+        with self._lock:
+            if self.finished.is_set():
+                return
+
+            num_frames = 0
+            while num_frames < out.shape[0] and self._chunks:
+                chunk = self._chunks[0]
+                count = min(chunk.shape[0] - self._position, out.shape[0] - num_frames)
+                out[num_frames:num_frames + count] +=\
+                    chunk[self._position:self._position + count]
+                num_frames += count
+                self._position += count
+
+                if self._position == chunk.shape[0]:
+                    self._chunks.popleft()
+                    self._position = 0
+
+            # If we've run out of samples of a sound that's still coming in, we
+            # play silence until more arrive
+            if not self._chunks and self._closed:
+                self.finished.set()
+
+
+class AudioOutput(object):
+    def __init__(self, frame_rate=DEFAULT_FRAME_RATE, channels=DEFAULT_CHANNELS,
+            frames_per_buffer=DEFAULT_FRAMES_PER_BUFFER, output_device_index=None):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self.output_device_index = output_device_index
+
+        self.clips = {}
+        self._sounds = []
+        self._sounds_lock = threading.Lock()
+        self._clips_lock = threading.Lock()
+        self._stream = None
+
+    def start(self):
+        # Opens the output stream, which happens the first time we play
+        # something, unless we call it ourselves
+        import pyaudio
+        with self._sounds_lock:
+            if self._stream is not None:
+                if self._stream.is_active():
+                    return
+
+                # The stream has been aborted, e.g. by an error in the callback
+                # or the device going away, so we open a new one
+                print("Error in AudioOutput.start: The output stream stopped, reopening it")
+                try:
+                    self._stream.close()
+                except Exception:
+                    pass
+                self._stream = None
+
+            self._stream = get_pyaudio().open(
+                format=pyaudio.paFloat32,
+                channels=self.channels,
+                rate=self.frame_rate,
+                frames_per_buffer=self.frames_per_buffer,
+                output=True,
+                output_device_index=self.output_device_index,
+                stream_callback=self._callback)
+
+    def close(self):
+        with self._sounds_lock:
+            sounds, self._sounds = self._sounds, []
+            stream, self._stream = self._stream, None
+
+        for sound in sounds:
+            sound.stop()
+        if stream is not None:
+            stream.stop_stream()
+            stream.close()
+
+    @property
+    def output_latency(self):
+        # Roughly how many seconds it takes for a sound we add to be heard,
+        # being up to a buffer until the callback mixes it in, plus however long
+        # the device takes to play that buffer
+        latency = self.frames_per_buffer / self.frame_rate
+        stream = self._stream
+        if stream is not None:
+            try:
+                latency += stream.get_output_latency()
+            except Exception:
+                pass
+        return latency
+
+    def to_samples(self, frames, sample_width, channels, frame_rate):
+        # Converts raw PCM frames to a (frames, channels) float32 tensor in the
+        # engine's format
+        dtype = {1: torch.uint8, 2: torch.int16, 4: torch.int32}.get(sample_width)
+        if dtype is None:
+            raise ValueError("Unsupported sample width %i" % sample_width)
+
+        samples = torch.frombuffer(bytearray(frames), dtype=dtype).to(torch.float32)
+        if dtype == torch.uint8:
+            samples = (samples - 128) / 128
+        else:
+            samples /= float(2 ** (8 * sample_width - 1))
+        samples = samples.view(-1, channels)
+
+        if channels != self.channels:
+            samples = samples.mean(dim=1, keepdim=True).expand(-1, self.channels)
+
+        if frame_rate != self.frame_rate and samples.shape[0]:
+            samples = torch.nn.functional.interpolate(
+                samples.t().unsqueeze(0),
+                size=max(int(round(samples.shape[0] * self.frame_rate / frame_rate)), 1),
+                mode="linear", align_corners=False)[0].t()
+
+        return samples.contiguous()
+
+    def load_clip(self, wav_path):
+        # Decodes a wav file into memory, once
+        with self._clips_lock:
+            if wav_path not in self.clips:
+                wavfile = wave.open(wav_path)
+                try:
+                    self.clips[wav_path] = self.to_samples(
+                        wavfile.readframes(wavfile.getnframes()), wavfile.getsampwidth(),
+                        wavfile.getnchannels(), wavfile.getframerate())
+                finally:
+                    wavfile.close()
+            return self.clips[wav_path]
+
+    def play(self, wav_path):
+        # Starts playing a clip and returns its Sound, without waiting for it
+        return self.add_sound(Sound(self.load_clip(wav_path)))
+
+    def open_sound(self):
+        # Starts playing a sound that will be fed its samples as they arrive
+        return self.add_sound(Sound())
+
+    def add_sound(self, sound):
+        self.start()
+        with self._sounds_lock:
+            self._sounds.append(sound)
+        return sound
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        import pyaudio
+        out = torch.zeros(frame_count, self.channels)
+
+        with self._sounds_lock:
+            sounds = list(self._sounds)
+
+        for sound in sounds:
+            sound.mix_into(out)
+
+        finished = [sound for sound in sounds if sound.finished.is_set()]
+        if finished:
+            with self._sounds_lock:
+                self._sounds = [sound for sound in self._sounds if sound not in finished]
+
+        return out.clamp_(-1, 1).numpy().tobytes(), pyaudio.paContinue
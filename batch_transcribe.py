@@ -0,0 +1,248 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import torch
+
+from gain_normalization import normalize_peak
+from inference_optimization import configure_threads
+from listener import load_models, _infer_intents_and_slots
+from replay import load_wav, SAMPLE_RATE
+
+
+# Runs directories (or manifests) of recorded voice commands through speech
+# recognition, the language model and intent inference, without a mic, so we
+# can evaluate the models on, and label, thousands of recordings at a time.
+#
+# The recordings are spread across a pool of processes, each of which loads
+# the models it needs (not the wake word model) once and is limited to a
+# single torch thread, so it scales with
+# the number of cores rather than fighting over them. The results are written
+# to a jsonl file as they come in and recordings that are already in it are
+# skipped, so an interrupted run can simply be started again.
+
+# The models of each worker process, loaded by `_init_worker`
+_models = None
+_num_top_results = 5
+
+
+def find_wav_paths(inputs):
+    # Each input is either a wav file, a directory that's searched for wav
+    # files, or a manifest with a path per line (.txt), or per json object with
+    # a "path" key (.jsonl), relative to the manifest
+    wav_paths = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for root, _, filenames in os.walk(input_path):
+                wav_paths += [os.path.join(root, filename) for filename in sorted(filenames)
+                    if filename.lower().endswith(".wav")]
+        elif input_path.lower().endswith((".txt", ".jsonl")):
+            manifest_dir = os.path.dirname(input_path)
+            with open(input_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    path = json.loads(line)["path"] if input_path.lower().endswith(".jsonl")\
+                        else line
+                    wav_paths.append(os.path.join(manifest_dir, path))
+        else:
+            wav_paths.append(input_path)
+    return wav_paths
+
+
+def read_done_paths(output_path):
+    # The recordings that already have a result in the output file. Failed ones
+    # and a line that got cut off by an interrupted run are ignored, so those
+    # recordings are redone.
+    done_paths = set()
+    if not os.path.exists(output_path):
+        return done_paths
+
+    with open(output_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if "path" in result and "error" not in result:
+                done_paths.add(result["path"])
+    return done_paths
+
+
+def _ends_with_partial_line(path):
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return False
+
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+
+def transcribe(models, samples, num_top_results=5):
+    # Returns the language model results and the (confidence, intent, slots)
+    # of each of them, the same way the listener processes a voice command
+    speech_recognition_model = models["speech_recognition_model"]
+    raw_speech_recognition_output = speech_recognition_model.recognize(
+        models["speech_recognition_preprocessor"](normalize_peak(samples).unsqueeze(0)),
+        *speech_recognition_model.get_initial_hidden(1))
+
+    top_language_model_results = models["language_model_decoder"].decode(
+        raw_speech_recognition_output, num_top_results=num_top_results)
+
+    return top_language_model_results, _infer_intents_and_slots(
+        models["joint_intent_and_slot_model"], top_language_model_results)
+
+
+def _load_models(model_paths, quantize, script, cache_dir):
+    # The speech recognition, joint intent and slot and language models, given
+    # in that order by `model_paths`
+    model_cache = None
+    if cache_dir:
+        from model_cache import ModelCache
+        model_cache = ModelCache(cache_dir)
+
+    return load_models(None, *model_paths, quantize=quantize, script=script,
+        model_cache=model_cache)
+
+
+def _warm_cache(model_paths, quantize, script, cache_dir):
+    # Prepares and caches the models and throws them away
+    configure_threads(1)
+    _load_models(model_paths, quantize, script, cache_dir)
+
+
+def _init_worker(model_paths, quantize, script, cache_dir, num_top_results):
+    global _models, _num_top_results
+    # One thread per process, as we get our parallelism from the processes
+    configure_threads(1)
+
+    _models = _load_models(model_paths, quantize, script, cache_dir)
+    _num_top_results = num_top_results
+
+
+def _process(wav_path):
+    start = time.perf_counter()
+    result = {"path": wav_path}
+    try:
+        samples = load_wav(wav_path)
+        with torch.no_grad():
+            top_results, inferred = transcribe(_models, samples, _num_top_results)
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+
+    # The most confident intent, like the listener picks it
+    best = max(range(len(inferred)), key=lambda i: inferred[i][0]) if inferred else None
+    result.update({
+        "duration": samples.shape[0] / SAMPLE_RATE,
+        "transcription": top_results[best] if best is not None else None,
+        "intent": inferred[best][1] if best is not None else None,
+        "confidence": float(inferred[best][0]) if best is not None else 0.,
+        "slots": inferred[best][2] if best is not None else {},
+        "top_results": list(top_results),
+        "processing_seconds": time.perf_counter() - start})
+    return result
+
+
+def run(wav_paths, output_path, model_paths, num_workers=None, quantize=False,
+        script=False, cache_dir=None, num_top_results=5, chunk_size=4):
+    # Processes the recordings that aren't in the output file yet and appends
+    # their results to it. Returns the number of processed and failed ones.
+    done_paths = read_done_paths(output_path)
+    wav_paths = [path for path in wav_paths if path not in done_paths]
+    if done_paths:
+        print("Skipping the recordings that have already been processed",
+            file=sys.stderr)
+
+    num_workers = num_workers or os.cpu_count() or 1
+    initargs = (model_paths, quantize, script, cache_dir, num_top_results)
+
+    # Make sure the models are cached before the workers all try to prepare
+    # them at the same time. That's done in a process of its own, so the
+    # parent doesn't keep a copy of the models, which each worker would inherit.
+    pool = None
+    if num_workers > 1 and wav_paths:
+        if cache_dir:
+            with multiprocessing.Pool(1) as warm_up_pool:
+                warm_up_pool.apply(_warm_cache, initargs[:4])
+        pool = multiprocessing.Pool(num_workers, _init_worker, initargs)
+        results = pool.imap_unordered(_process, wav_paths, chunksize=chunk_size)
+    else:
+        _init_worker(*initargs)
+        results = map(_process, wav_paths)
+
+    start = time.perf_counter()
+    num_processed = num_failed = 0
+    try:
+        with open(output_path, "a") as f:
+            # An interrupted run can leave the last line cut off, in which case
+            # we finish it off, so our first result doesn't get appended to it
+            if _ends_with_partial_line(output_path):
+                f.write("\n")
+
+            for result in results:
+                f.write(json.dumps(result, default=str) + "\n")
+                f.flush()
+
+                num_processed += 1
+                if "error" in result:
+                    num_failed += 1
+                    print("Error in batch_transcribe: Could not process %s - %s" % (
+                        result["path"], result["error"]), file=sys.stderr)
+
+                if num_processed % 100 == 0:
+                    print("Processed %i/%i recordings, %.1f per second" % (
+                            num_processed, len(wav_paths),
+                            num_processed / (time.perf_counter() - start)),
+                        file=sys.stderr)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    return num_processed, num_failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Transcribe and label recorded voice commands in parallel")
+    parser.add_argument("trained_speech_recognition_model_path",
+        help="path to the saved state of the trained speech recognition model")
+    parser.add_argument("trained_joint_intent_and_slot_model_path",
+        help="path to the saved state of the trained joined intent "
+             "inference and slot filling model")
+    parser.add_argument("language_model_path",
+        help="path to the language model")
+    parser.add_argument("inputs", nargs="+",
+        help="8kHz mono wav files, directories of them, or manifests (.txt or "
+             ".jsonl) listing them")
+    parser.add_argument("-o", "--output", required=True,
+        help="path to the jsonl file to append the results to")
+    parser.add_argument("-w", "--num_workers", type=int, default=0,
+        help="number of worker processes, defaults to the number of cores")
+    parser.add_argument("-ntr", "--num_top_results", type=int, default=5,
+        help="number of language model results to infer the intents of")
+    parser.add_argument("-q", "--quantize", action="store_true",
+        help="whether or not to quantize the models to int8 for faster CPU inference")
+    parser.add_argument("-js", "--script", action="store_true",
+        help="whether or not to script and freeze the models with TorchScript")
+    parser.add_argument("-cd", "--cache_dir",
+        help="directory to cache the prepared models in")
+
+    parsed_args = parser.parse_args()
+
+    wav_paths = find_wav_paths(parsed_args.inputs)
+    start = time.perf_counter()
+    num_processed, num_failed = run(wav_paths, parsed_args.output,
+        [parsed_args.trained_speech_recognition_model_path,
+         parsed_args.trained_joint_intent_and_slot_model_path,
+         parsed_args.language_model_path],
+        num_workers=parsed_args.num_workers, quantize=parsed_args.quantize,
+        script=parsed_args.script, cache_dir=parsed_args.cache_dir,
+        num_top_results=parsed_args.num_top_results)
+
+    print("Processed %i recordings (%i failed) in %.1fs" % (
+        num_processed, num_failed, time.perf_counter() - start), file=sys.stderr)
@@ -0,0 +1,42 @@
+import collections
+import torch
+
+
+def peak_scale(peak, eps=1e-8):
+    # The factor that brings the given peak to 1. Silence is left as is.
+    peak = float(peak)
+    return 1 / peak if peak > eps else 1.
+
+
+def normalize_peak(samples, out=None, peak=None, eps=1e-8):
+    # Scales the samples so their peak absolute amplitude is 1, which is what
+    # `sox gain -n` does, but without round tripping through the sox effects chain.
+    #
+    # If `out` is not given the samples are normalized in place. If `peak` is not
+    # given it's computed from the samples. Silence (a peak of 0) is left as is.
+    if peak is None:
+        peak = samples.abs().max() if samples.numel() else 0
+
+    if out is None:
+        out = samples
+
+    return torch.mul(samples, peak_scale(peak, eps), out=out)
+
+
+class WindowPeakTracker(object):
+    # Keeps the peak absolute amplitude of the last `num_chunks` chunks, so we
+    # can get the peak of a sliding window by only scanning the newest chunk,
+    # rather than the whole window every time it moves.
+    def __init__(self, num_chunks):
+        self.chunk_peaks = collections.deque(maxlen=num_chunks)
+
+    def clear(self):
+        self.chunk_peaks.clear()
+
+    def update(self, chunk):
+        self.chunk_peaks.append(float(chunk.abs().max()) if chunk.numel() else 0.)
+        return self.peak
+
+    @property
+    def peak(self):
+        return max(self.chunk_peaks) if self.chunk_peaks else 0.
@@ -0,0 +1,261 @@
+import argparse
+import mmap
+import re
+import struct
+import unicodedata
+
+
+# An offline index of place names, so resolving the location slot of a command
+# to a lat/long, name and timezone doesn't need a request.
+#
+# It's built from one of the GeoNames city dumps (e.g. cities15000.txt from
+# https://download.geonames.org/export/dump/) with
+#   python gazetteer.py cities15000.txt data/gazetteer.idx
+# and memory mapped when loaded, so only the pages we look at are ever read.
+#
+# The file is laid out as
+# - a header of the number of keys and places and the size of the strings
+# - the offsets of the keys, which are the normalized place names, sorted, so
+#   we can binary search them
+# - the place of each key, being the most populated one with that name
+# - the places, as (lat, long, population, timezone index, name offset)
+# - the key, name and timezone strings
+#
+# Each place is indexed under its name, its ascii name and its alternate names,
+# so e.g. "new york" finds New York City.
+#
+# Names that don't match exactly, e.g. because of a misspelling by the speech
+# recognition, are fuzzy matched against the keys starting with the same letter.
+# The shorter the name, the fewer edits we allow, as there are only so many
+# ways to misspell "rome" before it becomes another city, and a fuzzy match is
+# only used if it's closer than the closest match of any other place.
+
+MAGIC = b"KGZ1"
+HEADER = struct.Struct("<4sIII")
+PLACE = struct.Struct("<ffIHI")
+OFFSET = struct.Struct("<I")
+
+
+def normalize(name):
+    # Lower case ascii, without punctuation or repeated spaces
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^a-z0-9 ]", " ", name.lower()).split())
+
+
+def allowed_distance(key, max_distance):
+    # The number of edits we forgive for a key of that length
+    if len(key) < 4:
+        return 0
+    if len(key) < 6:
+        return min(max_distance, 1)
+    return max_distance
+
+
+def edit_distance(a, b, max_distance):
+    # Levenshtein distance, giving up once it's over `max_distance`
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class Place(object):
+    __slots__ = ("name", "latlong", "timezone", "population")
+
+    def __init__(self, name, latlong, timezone, population):
+        self.name = name
+        self.latlong = latlong
+        self.timezone = timezone
+        self.population = population
+
+
+class Gazetteer(object):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < HEADER.size or self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError("%s is not a gazetteer index" % path)
+        _, self.num_keys, self.num_places, strings_size = HEADER.unpack_from(self._mmap)
+
+        self._key_offsets_start = HEADER.size
+        self._key_places_start = self._key_offsets_start + OFFSET.size * (self.num_keys + 1)
+        self._places_start = self._key_places_start + OFFSET.size * self.num_keys
+        self._strings_start = self._places_start + PLACE.size * self.num_places
+        timezones_start = self._strings_start + strings_size
+        if len(self._mmap) < timezones_start:
+            self._mmap.close()
+            raise ValueError("%s is a truncated gazetteer index" % path)
+
+        # There are only a few hundred timezones, so we read them up front
+        self.timezones = self._mmap[timezones_start:].decode("utf-8").split("\n")
+        self._fuzzy_cache = {}
+
+    def close(self):
+        self._mmap.close()
+
+    def _key(self, i):
+        start, end = struct.unpack_from("<II", self._mmap,
+            self._key_offsets_start + OFFSET.size * i)
+        return self._mmap[self._strings_start + start:self._strings_start + end]
+
+    def _place_index(self, key_index):
+        return OFFSET.unpack_from(self._mmap,
+            self._key_places_start + OFFSET.size * key_index)[0]
+
+    def _place(self, key_index):
+        place_index = self._place_index(key_index)
+        lat, long, population, timezone_index, name_offset = PLACE.unpack_from(
+            self._mmap, self._places_start + PLACE.size * place_index)
+
+        name_start = self._strings_start + name_offset
+        name_end = self._mmap.find(b"\n", name_start)
+        return Place(self._mmap[name_start:name_end].decode("utf-8"),
+            (lat, long), self.timezones[timezone_index], population)
+
+    def _bisect(self, key):
+        # Index of the first key that isn't smaller than `key`
+        low, high = 0, self.num_keys
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, name, max_distance=2):
+        # Returns the Place matching the name, or None. If there's no exact
+        # match, the closest key within `max_distance` edits (fewer for short
+        # names) is used, as long as no other place is as close.
+        key = normalize(name).encode("ascii")
+        if not key:
+            return None
+
+        i = self._bisect(key)
+        if i < self.num_keys and self._key(i) == key:
+            return self._place(i)
+
+        max_distance = allowed_distance(key, max_distance)
+        if not max_distance:
+            return None
+
+        if key not in self._fuzzy_cache:
+            self._fuzzy_cache[key] = self._fuzzy_match(key, max_distance)
+        match = self._fuzzy_cache[key]
+        return self._place(match) if match is not None else None
+
+    def _fuzzy_match(self, key, max_distance):
+        # Only the keys starting with the same letter are compared, as the
+        # speech recognition rarely gets the first letter wrong
+        start = self._bisect(key[:1])
+        end = self._bisect(key[:1] + b"\xff")
+
+        # The closest key of each place, as several keys can lead to the same one
+        distances = {}
+        text = key.decode("ascii")
+        for i in range(start, end):
+            candidate = self._key(i)
+            if abs(len(candidate) - len(key)) > max_distance:
+                continue
+
+            distance = edit_distance(text, candidate.decode("ascii"), max_distance)
+            if distance > max_distance:
+                continue
+
+            place_index = self._place_index(i)
+            if place_index not in distances or distance < distances[place_index][0]:
+                distances[place_index] = (distance, i)
+
+        # If another place is just as close, we can't tell which one was meant
+        matches = sorted(distances.values())
+        if not matches or (len(matches) > 1 and matches[1][0] == matches[0][0]):
+            return None
+        return matches[0][1]
+
+
+def build(geonames_path, output_path):
+    # Builds the index from a GeoNames dump, which is tab separated with the
+    # name, ascii name, comma separated alternate names, latitude, longitude,
+    # population and timezone in columns 1, 2, 3, 4, 5, 14 and 17
+    places = []
+    place_names = []
+    with open(geonames_path, encoding="utf-8") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 18:
+                continue
+            places.append((columns[1], float(columns[4]), float(columns[5]),
+                int(columns[14] or 0), columns[17]))
+            place_names.append([columns[1], columns[2]] +
+                [name for name in columns[3].split(",") if name])
+
+    timezones = sorted(set(place[4] for place in places))
+    timezone_indices = {timezone: i for i, timezone in enumerate(timezones)}
+
+    # Each key points to the most populated place with that as its name, or
+    # failing that, as one of its alternate names, and we only keep the places
+    # that a key points to
+    key_places = {}
+    key_ranks = {}
+    for place_index, names in enumerate(place_names):
+        population = places[place_index][3]
+        for name_index, name in enumerate(names):
+            key = normalize(name)
+            rank = (name_index < 2, population)
+            if key and (key not in key_ranks or rank > key_ranks[key]):
+                key_places[key] = place_index
+                key_ranks[key] = rank
+    keys = sorted(key_places.keys())
+
+    kept_places = sorted(set(key_places.values()))
+    kept_indices = {place_index: i for i, place_index in enumerate(kept_places)}
+    places = [places[place_index] for place_index in kept_places]
+    key_places = {key: kept_indices[place_index] for key, place_index in key_places.items()}
+
+    strings = bytearray()
+    key_offsets = []
+    for key in keys:
+        key_offsets.append(len(strings))
+        strings += key.encode("ascii")
+    key_offsets.append(len(strings))
+
+    place_records = bytearray()
+    for name, lat, long, population, timezone in places:
+        place_records += PLACE.pack(lat, long, population, timezone_indices[timezone],
+            len(strings))
+        strings += name.replace("\n", " ").encode("utf-8") + b"\n"
+
+    with open(output_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(keys), len(places), len(strings)))
+        f.write(b"".join(OFFSET.pack(offset) for offset in key_offsets))
+        f.write(b"".join(OFFSET.pack(key_places[key]) for key in keys))
+        f.write(place_records)
+        f.write(strings)
+        f.write("\n".join(timezones).encode("utf-8"))
+
+    return len(keys), len(places)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the offline place name index from a GeoNames dump")
+    parser.add_argument("geonames_path",
+        help="path to a GeoNames cities dump, e.g. cities15000.txt")
+    parser.add_argument("output_path",
+        help="path to write the index to, e.g. data/gazetteer.idx")
+
+    parsed_args = parser.parse_args()
+
+    num_keys, num_places = build(parsed_args.geonames_path, parsed_args.output_path)
+    print("Indexed %i names of %i places" % (num_keys, num_places))
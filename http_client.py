@@ -0,0 +1,137 @@
+import collections
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+
+# A shared http client for the intent handlers, so looking up the weather
+# doesn't pay for a new connection (DNS, TCP and TLS) on every request and
+# doesn't send the same geocoding lookups over and over again.
+#
+# It
+# - keeps a pooled requests session around, so connections are reused
+# - times out, rather than leaving the intent hanging forever
+# - caches the json responses for as long as the caller says they're fresh,
+#   evicting the least recently used ones when there are too many of them
+# - persists the cache to disk, so it survives restarts
+#
+# If a request fails, we fall back to a stale cached response if we have one,
+# since an old forecast is better than no answer at all.
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "kronos", "http_cache.json")
+
+
+class HttpClient(object):
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, max_cache_entries=512,
+            connect_timeout=3, read_timeout=5, pool_size=4,
+            user_agent="Kronos voice assistant"):
+        self.cache_path = cache_path
+        self.max_cache_entries = max_cache_entries
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.user_agent = user_agent
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.stale_count = 0
+
+        self._session = None
+        self._lock = threading.Lock()
+
+        # Cache key -> (time it was fetched, response), in least recently used order
+        self._cache = collections.OrderedDict()
+        if cache_path:
+            try:
+                with open(cache_path) as f:
+                    for key, (fetched_at, response) in json.load(f):
+                        self._cache[key] = (fetched_at, response)
+            except (IOError, ValueError, TypeError):
+                pass
+
+    @property
+    def session(self):
+        # requests is only imported the first time we make a request, so it
+        # doesn't slow down starting up
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size, max_retries=1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = self.user_agent
+            self._session = session
+        return self._session
+
+    def get_json(self, url, params=None, max_age=0):
+        # Returns the decoded json response, or None if the request failed and
+        # there's nothing cached. Responses younger than `max_age` seconds are
+        # served from the cache without making a request.
+        if params:
+            url = "%s?%s" % (url, urllib.parse.urlencode(params))
+
+        with self._lock:
+            cached = self._cache.get(url)
+            if cached is not None:
+                self._cache.move_to_end(url)
+                if time.time() - cached[0] < max_age:
+                    self.hit_count += 1
+                    return cached[1]
+        self.miss_count += 1
+
+        try:
+            request = self.session.get(url, timeout=self.timeout)
+            request.raise_for_status()
+            response = request.json()
+        except Exception as e:
+            if cached is not None:
+                print("Error in HttpClient.get_json: Request to %s failed, "
+                      "using a stale response - " % url, e)
+                self.stale_count += 1
+                return cached[1]
+
+            print("Error in HttpClient.get_json: Request to %s failed - " % url, e)
+            return None
+
+        if max_age > 0:
+            with self._lock:
+                self._cache[url] = (time.time(), response)
+                self._cache.move_to_end(url)
+                while len(self._cache) > self.max_cache_entries:
+                    self._cache.popitem(last=False)
+            self.save_cache()
+
+        return response
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+
+        with self._lock:
+            entries = list(self._cache.items())
+
+        # Write to a temporary file first, so a crash never leaves half a cache
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            tmp_path = "%s.%i.%i.tmp" % (
+                self.cache_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            print("Error in HttpClient.save_cache: Could not write %s - " % self.cache_path, e)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+        self.save_cache()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
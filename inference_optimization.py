@@ -0,0 +1,179 @@
+import argparse
+import io
+import json
+import os
+import platform
+import torch
+
+
+# Optional optimizations for running the models on small CPU only machines
+# - dynamic int8 quantization of the Linear and LSTM layers, which makes them
+#   both faster and a lot smaller in memory
+# - scripting and freezing the submodules of the models with TorchScript
+# - pinning the number of threads torch uses
+
+
+def configure_threads(num_threads):
+    # By default torch uses as many threads as there are cores, which on small
+    # machines means fighting with the mic capture and everything else
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        # It can only be set once and before any inter-op parallel work
+        pass
+
+
+def _configure_quantized_engine():
+    # fbgemm is x86 only, so use qnnpack on ARM (e.g. Raspberry Pis)
+    engines = torch.backends.quantized.supported_engines
+    if platform.machine().lower().startswith(("arm", "aarch64")) and "qnnpack" in engines:
+        torch.backends.quantized.engine = "qnnpack"
+
+
+def quantize_model(model):
+    # Returns a copy of the model with its Linear and LSTM layers dynamically
+    # quantized to int8. The copy keeps the class of the original, so methods
+    # like `classify` or `recognize` still work.
+    _configure_quantized_engine()
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+
+
+def _script(module):
+    # Scripting some modules, like the LSTM on recent versions of torch,
+    # succeeds, but leaves them without a forward method, so they can't be
+    # called, in which case we raise and the module is left as it is
+    scripted = torch.jit.script(module.eval())
+    if not hasattr(scripted, "forward"):
+        raise RuntimeError("The scripted %s has no forward method" % type(module).__name__)
+
+    # Freezing some modules, like the quantized LSTM, strips their forward
+    # method, in which case we keep them scripted, but not frozen
+    frozen = torch.jit.freeze(scripted)
+    return frozen if hasattr(frozen, "forward") else scripted
+
+
+def script_submodules(model):
+    # The models' own inference methods are plain python, so rather than
+    # scripting the whole model, we script and freeze each of its direct
+    # submodules, leaving the ones that can't be scripted as they are
+    for name, submodule in list(model.named_children()):
+        try:
+            scripted = _script(submodule)
+        except Exception as e:
+            print("Error in inference_optimization.script_submodules: "
+                  "Could not script %s.%s, leaving it as is - %s" % (
+                      type(model).__name__, name, str(e).split("\n")[0]))
+            continue
+        setattr(model, name, scripted)
+    return model
+
+
+def optimize_model(model, quantize=True, script=False):
+    if quantize:
+        model = quantize_model(model)
+    if script:
+        model = script_submodules(model)
+    model.eval()
+    return model
+
+
+def model_size(model):
+    # Size of the model's serialized state in bytes. We serialize it, as the
+    # quantized weights are packed and not stored as plain tensors.
+    # NOTE: Frozen TorchScript submodules fold their weights into constants, so
+    # they don't show up here, which is why the sizes are best compared without
+    # scripting.
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def check_accuracy(reference_models, optimized_models, samples):
+    # Runs the same samples through the fp32 and the optimized models and
+    # reports how often they agree on
+    # - the wake word classification
+    # - the top language model result
+    # - the intent of the most confident result
+    from listener import WAKE_WINDOW_SIZE, WAKE_PADDED_WINDOW_SIZE,\
+        _infer_intents_and_slots
+    from gain_normalization import normalize_peak
+
+    def run(models, samples):
+        # The wake word detection runs on the beginning of the sample, padded
+        # the same way the listener does it
+        padded = torch.zeros(WAKE_PADDED_WINDOW_SIZE)
+        normalize_peak(samples[:WAKE_WINDOW_SIZE],
+            out=padded[:min(samples.shape[0], WAKE_WINDOW_SIZE)])
+        wake_word_class = models["wake_word_detection_model"].classify(
+            models["wake_word_preprocessor"](padded.unsqueeze(0))).item()
+
+        speech_recognition_model = models["speech_recognition_model"]
+        raw_output = speech_recognition_model.recognize(
+            models["speech_recognition_preprocessor"](
+                normalize_peak(samples.clone()).unsqueeze(0)),
+            *speech_recognition_model.get_initial_hidden(1))
+        results = models["language_model_decoder"].decode(raw_output, num_top_results=5)
+
+        inferred = _infer_intents_and_slots(models["joint_intent_and_slot_model"], results)
+        intent = max(inferred, key=lambda x: x[0])[1] if inferred else None
+        return wake_word_class, results[0] if results else None, intent
+
+    agreements = {"wake_word": 0, "transcription": 0, "intent": 0}
+    with torch.no_grad():
+        for sample in samples:
+            for key, reference, optimized in zip(["wake_word", "transcription", "intent"],
+                    run(reference_models, sample), run(optimized_models, sample)):
+                agreements[key] += reference == optimized
+
+    num_samples = max(len(samples), 1)
+    return {
+        "samples": len(samples),
+        "agreement": {key: count / num_samples for key, count in agreements.items()},
+        "model_sizes_mb": {name: {
+                "reference": model_size(reference_models[name]) / 2 ** 20,
+                "optimized": model_size(optimized_models[name]) / 2 ** 20}
+            for name in ["wake_word_detection_model", "speech_recognition_model",
+                         "joint_intent_and_slot_model"]}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the accuracy of the optimized models against the fp32 ones")
+    parser.add_argument("trained_wake_word_model_path",
+        help="path to the saved state of the trained wake word detection model")
+    parser.add_argument("trained_speech_recognition_model_path",
+        help="path to the saved state of the trained speech recognition model")
+    parser.add_argument("trained_joint_intent_and_slot_model_path",
+        help="path to the saved state of the trained joined intent "
+             "inference and slot filling model")
+    parser.add_argument("language_model_path",
+        help="path to the language model")
+    parser.add_argument("held_out_dir",
+        help="directory of held out 8kHz mono wav files")
+    parser.add_argument("-js", "--script", action="store_true",
+        help="also script and freeze the models with TorchScript")
+    parser.add_argument("-nt", "--num_threads", type=int, default=0,
+        help="number of threads torch is allowed to use")
+
+    parsed_args = parser.parse_args()
+
+    from listener import load_models
+    from replay import load_wav
+
+    if parsed_args.num_threads:
+        configure_threads(parsed_args.num_threads)
+
+    model_paths = [parsed_args.trained_wake_word_model_path,
+        parsed_args.trained_speech_recognition_model_path,
+        parsed_args.trained_joint_intent_and_slot_model_path,
+        parsed_args.language_model_path]
+    reference_models = load_models(*model_paths)
+    optimized_models = load_models(*model_paths, quantize=True, script=parsed_args.script)
+
+    samples = [load_wav(os.path.join(parsed_args.held_out_dir, filename))
+        for filename in sorted(os.listdir(parsed_args.held_out_dir))
+        if filename.lower().endswith(".wav")]
+
+    print(json.dumps(check_accuracy(reference_models, optimized_models, samples), indent=2))
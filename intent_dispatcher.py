@@ -0,0 +1,84 @@
+import concurrent.futures
+import threading
+
+
+class IntentDispatcher(object):
+    # Runs the intent handlers (and speaking their responses) on a pool of
+    # threads, so the listener can keep listening for the wake and stop words
+    # while we're waiting on a weather service or talking.
+    #
+    # Each job is given a cancel event, which is set when the job is cancelled
+    # (e.g. by the stop word) or when it runs for longer than its timeout. We
+    # can't forcefully stop a thread, so it's up to the job to check the event
+    # and give up, e.g. not speak a response that came in too late or stop
+    # playing the audio half way through.
+    #
+    # At most `max_in_flight` jobs run at the same time and anything submitted
+    # on top of that is rejected. A `max_in_flight` of 0 runs every job straight
+    # away on the calling thread, like we used to.
+    def __init__(self, max_in_flight=2):
+        self.max_in_flight = max_in_flight
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_in_flight) if max_in_flight else None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def in_flight_count(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def submit(self, name, job, timeout=None):
+        # Returns False if the job has been rejected, because too many are
+        # already running
+        cancel_event = threading.Event()
+
+        if not self.executor:
+            job(cancel_event)
+            return True
+
+        with self._lock:
+            if len(self._in_flight) >= self.max_in_flight:
+                return False
+
+            future = self.executor.submit(self._run, name, job, cancel_event, timeout)
+            self._in_flight[future] = cancel_event
+        future.add_done_callback(self._done)
+        return True
+
+    def cancel_all(self):
+        # Returns the number of jobs that have been cancelled
+        with self._lock:
+            cancel_events = list(self._in_flight.values())
+
+        for cancel_event in cancel_events:
+            cancel_event.set()
+        return len(cancel_events)
+
+    def shutdown(self):
+        self.cancel_all()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def _run(self, name, job, cancel_event, timeout):
+        timer = None
+        if timeout:
+            def time_out():
+                print("Error in IntentDispatcher: %s took longer than %.1fs, "
+                      "cancelling it" % (name, timeout))
+                cancel_event.set()
+
+            timer = threading.Timer(timeout, time_out)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            job(cancel_event)
+        except Exception as e:
+            print("Error in IntentDispatcher: %s failed - " % name, e)
+        finally:
+            if timer:
+                timer.cancel()
+
+    def _done(self, future):
+        with self._lock:
+            self._in_flight.pop(future, None)
@@ -2,76 +2,150 @@ from datetime import datetime, timedelta
 from word2number import w2n
 from num2words import num2words
 import re
-import requests
-import urllib.parse
-import json
-from timezonefinder import TimezoneFinder
-import pytz
-import threading
-import time
-import wave
-import pyaudio
-from functools import partial
 
 
 HOME_LOCATION_WOEID = 44418 # London
 HOME_LOCATION_LATLONG = 51, 0
 TIMER_WAV_FILE_PATH = "data/timer.wav"
+# Built with gazetteer.py. Without it, we look up every location online.
+GAZETTEER_PATH = "data/gazetteer.idx"
+
+GEOCODING_URL = "https://nominatim.openstreetmap.org/search"
+WEATHER_URL = "https://www.metaweather.com/api/location"
+
+# How long the responses of each endpoint stay fresh for, in seconds. Places
+# don't move, but the forecasts get updated every now and then.
+GEOCODING_MAX_AGE = 30 * 24 * 60 * 60
+LOCATION_SEARCH_MAX_AGE = 30 * 24 * 60 * 60
+CURRENT_WEATHER_MAX_AGE = 10 * 60
+FUTURE_WEATHER_MAX_AGE = 60 * 60
+
+# The responses that we give, which the voice synthesizer can split into their
+# fixed and variable parts, so it only needs to synthesize the fixed parts once
+CURRENT_WEATHER_RESPONSE = "The temperature in %s is currently %i degrees"
+FUTURE_WEATHER_RESPONSE = "The temperature in %s on the %s of %s will be %i degrees"
+CURRENT_TIME_RESPONSE = "The current time in %s is %s"
+RESPONSE_TEMPLATES = [CURRENT_WEATHER_RESPONSE, FUTURE_WEATHER_RESPONSE,
+    CURRENT_TIME_RESPONSE]
+
+# The heavier dependencies (the http client, timezonefinder, pytz, the audio
+# output and the timer scheduler) are only imported the first time they're
+# needed, so they don't slow down starting up
+_timezone_finder = None
+_http_client = None
+_timer_scheduler = None
+_gazetteer = None
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        from http_client import HttpClient
+        _http_client = HttpClient()
+    return _http_client
+
+def get_gazetteer():
+    # Returns None if there's no index to load
+    global _gazetteer
+    if _gazetteer is None:
+        from gazetteer import Gazetteer
+        try:
+            _gazetteer = Gazetteer(GAZETTEER_PATH)
+        except (IOError, ValueError) as e:
+            print("Error in intent_handler.get_gazetteer: Could not load %s, "
+                  "looking up locations online instead - " % GAZETTEER_PATH, e)
+            _gazetteer = False
+    return _gazetteer or None
+
+def get_timezone_finder():
+    global _timezone_finder
+    if _timezone_finder is None:
+        from timezonefinder import TimezoneFinder
+        _timezone_finder = TimezoneFinder()
+    return _timezone_finder
+
+def get_timer_scheduler():
+    # Starts the timer scheduler, which also resumes any timers that were
+    # pending when we were last shut down
+    global _timer_scheduler
+    if _timer_scheduler is None:
+        from timer_scheduler import TimerScheduler
+        _timer_scheduler = TimerScheduler(on_fire=lambda timer: play_timer_sound())
+        # The resumed timers fire through the same alarm as new ones, so it's
+        # loaded now, rather than when the first of them goes off
+        if _timer_scheduler.list():
+            load_timer_sound()
+        _timer_scheduler.start()
+    return _timer_scheduler
+
+def load_timer_sound():
+    # The alarm is decoded into memory once, rather than every time a timer fires
+    from audio_output import get_audio_output
+    get_audio_output().load_clip(TIMER_WAV_FILE_PATH)
+
+def play_timer_sound():
+    # This doesn't wait for the alarm to finish, so the timer scheduler can go
+    # straight back to waiting for the next timer
+    from audio_output import get_audio_output
+    get_audio_output().play(TIMER_WAV_FILE_PATH)
+
+def describe_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    parts = ["%i %s" % (count, name if count == 1 else name + "s")
+        for count, name in [(hours, "hour"), (minutes, "minute"), (seconds, "second")]
+        if count]
+    return " and ".join(parts) if parts else "0 seconds"
+
+def get_location(slots):
+    # Returns the lat/long, name and timezone of the location slot, or of home
+    # if there isn't one. The timezone is None if we don't know it yet.
+    if "location" not in slots.keys():
+        return HOME_LOCATION_LATLONG, "London", None
 
-timezone_finder = TimezoneFinder()
-p = pyaudio.PyAudio()
-threads = []
-
-def timer(delay_in_seconds):
-    time.sleep(delay_in_seconds)
+    # Most of the time, the location is a city we have in the offline index,
+    # which also forgives the odd misspelling by the speech recognition
+    gazetteer = get_gazetteer()
+    place = gazetteer.lookup(slots["location"]) if gazetteer else None
+    if place:
+        return place.latlong, place.name, place.timezone or None
 
-    wf = wave.open(TIMER_WAV_FILE_PATH)
-    stream = p.open(
-        format=pyaudio.get_format_from_width(wf.getsampwidth()),
-        channels=wf.getnchannels(),
-        rate=wf.getframerate(),
-        output=True)
+    # Bit weird to use a different api for this, but the metaweather one
+    # seems to be a one man operation and i don't want to use it if i can help it
+    location_info = get_http_client().get_json(GEOCODING_URL,
+        {"q":slots["location"], "format":"json"}, max_age=GEOCODING_MAX_AGE)
 
-    data = wf.readframes(1024)
-    while data:
-        stream.write(data)
-        data = wf.readframes(1024)
+    if location_info:
+        return (float(location_info[0]["lat"]), float(location_info[0]["lon"])),\
+            location_info[0]["display_name"].split(",")[0], None
 
-    stream.close()
-    wf.close()
+    print("Error in intent_handler.get_location: "
+          "Unrecognized location %s" % slots["location"])
+    return None, None, None
 
 def get_location_latlong(slots):
-    if "location" not in slots.keys():
-        return HOME_LOCATION_LATLONG, "London"
-    else:
-        # Bit weird to use a different api for this, but the metaweather one
-        # seems to be a one man operation and i don't want to use it if i can help it
-        request = requests.get("https://nominatim.openstreetmap.org/search?%s&format=json" % (
-            urllib.parse.urlencode({"q":slots["location"]})))
-
-        location_info = json.loads(request.text)
-
-        if location_info:
-            return (float(location_info[0]["lat"]), float(location_info[0]["lon"])),\
-                location_info[0]["display_name"].split(",")[0]
-
-        print("Error in intent_handler.get_location_latlong: "
-              "Unrecognized location %s" % slots["location"])
-        return None, None
+    latlong, location_name, _ = get_location(slots)
+    return latlong, location_name
 
 def get_timezone_from_latlong(latlong):
-    return timezone_finder.timezone_at(lat=latlong[0], lng=latlong[1])
+    return get_timezone_finder().timezone_at(lat=latlong[0], lng=latlong[1])
 
 def get_location_info(location):
-    request = requests.get("https://www.metaweather.com/api/location/search/?%s" %\
-            urllib.parse.urlencode({"query":location}))
-    return json.loads(request.text)
+    return get_http_client().get_json(WEATHER_URL + "/search/",
+        {"query":location}, max_age=LOCATION_SEARCH_MAX_AGE)
 
 def get_location_woeid(slots):
     if "location" not in slots.keys():
         return HOME_LOCATION_WOEID, "London"
     else:
-        location_info = get_location_info(slots["location"])
+        # The offline index corrects misspellings, which metaweather doesn't,
+        # and means the same city always hits the same cached response
+        location = slots["location"]
+        gazetteer = get_gazetteer()
+        place = gazetteer.lookup(location) if gazetteer else None
+        if place:
+            location = place.name
+
+        location_info = get_location_info(location)
         if not location_info:
             print("Error in intent_handler.get_location_woeid: "
                   "Unrecognized location %s" % slots["location"])
@@ -137,15 +211,16 @@ class IntentHandler(object):
         if not location_woeid:
             return
 
-        request = requests.get("https://www.metaweather.com/api/location/%i" % location_woeid)
-        weather_info = json.loads(request.text)
+        weather_info = get_http_client().get_json("%s/%i" % (WEATHER_URL, location_woeid),
+            max_age=CURRENT_WEATHER_MAX_AGE)
 
         if not weather_info:
             print("Error in IntentHandler.weather_current: Could not find a forecast. slots - ", slots)
+            return
 
         first_forecast = weather_info["consolidated_weather"][0]
 
-        return "The temperature in %s is currently %i degrees" % (
+        return CURRENT_WEATHER_RESPONSE % (
             location_name, first_forecast["the_temp"])
 
     @staticmethod
@@ -168,37 +243,35 @@ class IntentHandler(object):
         if not location_woeid:
             return
 
-        request = requests.get("https://www.metaweather.com/api/location/%i/%s" % (
-            location_woeid, time_in_future.strftime("%Y/%m/%d")))
-        weather_info = json.loads(request.text)
+        weather_info = get_http_client().get_json("%s/%i/%s" % (
+            WEATHER_URL, location_woeid, time_in_future.strftime("%Y/%m/%d")),
+            max_age=FUTURE_WEATHER_MAX_AGE)
+
+        if not weather_info:
+            print("Error in IntentHandler.weather_future: Could not find a forecast. slots - ", slots)
+            return
 
         first_forecast = weather_info[0]
 
-        return "The temperature in %s on the %s of %s will be %i degrees" % (
+        return FUTURE_WEATHER_RESPONSE % (
             location_name, num2words(time_in_future.day, ordinal=True),
             time_in_future.strftime("%B"), first_forecast["the_temp"])
 
     @staticmethod
     def time_current(slots):
-        latlong, location_name = get_location_latlong(slots)
+        import pytz
+        latlong, location_name, timezone_name = get_location(slots)
 
         if not latlong:
             return
 
-        timezone = pytz.timezone(get_timezone_from_latlong(latlong))
+        timezone = pytz.timezone(timezone_name or get_timezone_from_latlong(latlong))
 
-        return "The current time in %s is %s" % (location_name,
+        return CURRENT_TIME_RESPONSE % (location_name,
                     datetime.now(timezone).strftime("%H:%M"))
 
     @staticmethod
     def time_timer(slots):
-        global threads
-        for thread in threads:
-            if thread.is_alive():
-                print("Error in IntentHandler.time_timer: There's already a timer running")
-                return
-        threads = []
-
         if not "time" in slots.keys():
             print("Error in IntentHandler.time_timer: No time slot was provided")
             return
@@ -212,8 +285,37 @@ class IntentHandler(object):
 
         time_in_seconds = future_time_delta.total_seconds()
 
-        threads.append(threading.Thread(target=partial(timer, time_in_seconds)))
-        threads[-1].start()
+        # Load the alarm now, so it's ready by the time the timer fires
+        load_timer_sound()
+        get_timer_scheduler().add(time_in_seconds, label=slots["time"])
+
+    @staticmethod
+    def time_timer_list(slots):
+        scheduler = get_timer_scheduler()
+        timers = scheduler.list()
+        if not timers:
+            response = "There are no timers running"
+        else:
+            response = "There %s %i %s running, with %s left" % (
+                "is" if len(timers) == 1 else "are", len(timers),
+                "timer" if len(timers) == 1 else "timers",
+                ", ".join(describe_duration(timer.remaining()) for timer in timers))
+
+        # The timers that went off while we weren't running are only mentioned once
+        missed_timers = scheduler.pop_missed_timers()
+        if missed_timers:
+            response = "%i %s went off while I wasn't running. %s" % (
+                len(missed_timers), "timer" if len(missed_timers) == 1 else "timers",
+                response)
+        return response
+
+    @staticmethod
+    def time_timer_cancel(slots):
+        count = get_timer_scheduler().cancel_all()
+        if not count:
+            return "There are no timers running"
+
+        return "Cancelled %i %s" % (count, "timer" if count == 1 else "timers")
 
     @staticmethod
     def other(slots):
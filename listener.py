@@ -1,8 +1,8 @@
 import argparse
-import pyaudio
+import concurrent.futures
+import inspect
+import time
 import torch
-import torchaudio
-import wave
 
 from wake_word_detection.model import WWDModel as WakeWordDetectionModel
 from wake_word_detection.data import Preprocessor as WakeWordPreprocessor
@@ -11,6 +11,26 @@ from speech_recognition.data import Preprocessor as SpeechRecognitionPreprocesso
     LanaguageModelDecoder
 from intent_and_slot_inference.model import JointIntentAndSlotsModel
 
+from audio_buffer import RingBuffer
+from audio_capture import AudioCapture
+from gain_normalization import normalize_peak, WindowPeakTracker
+from wake_features import WakeFeatureCache
+from voice_activity_detection import VoiceActivityDetector, EnergyGate
+from streaming_recognition import StreamingRecognizer, supports_streaming
+from metrics import Metrics
+from audio_output import get_audio_output, get_pyaudio, shutdown as shutdown_audio
+from intent_dispatcher import IntentDispatcher
+from inference_optimization import optimize_model, quantize_model
+
+
+# The wake word detection runs on the last second and a half of recording,
+# padded with zeros to three seconds.
+# 8000 is the sample rate. We read from the mic in chunks of half a second.
+CHUNK_SIZE = 4000
+WAKE_WINDOW_SIZE = int(8000 * 1.5)
+WAKE_PADDED_WINDOW_SIZE = 8000 * 3
+WAKE_WORD_ACTIONS = ["wake","stop","pass"]
+
 
 def _load_model(model_class, state_dict_path, *args, **kwargs):
     model = model_class(*args, **kwargs)
@@ -18,219 +38,513 @@ def _load_model(model_class, state_dict_path, *args, **kwargs):
     model.eval()
     return model
 
+def _load_state_dict(model, state_dict):
+    # Assigning, rather than copying, keeps memory mapped weights memory mapped
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        model.load_state_dict(state_dict)
+
+def _load_cached_model(model_class, state_dict_path, model_cache,
+        quantize=False, script=False):
+    if model_cache is None:
+        model = _load_model(model_class, state_dict_path)
+    elif quantize:
+        # A quantized state dict can only be loaded into an already quantized model
+        state_dict = model_cache.load_prepared_state_dict(state_dict_path, "quantized")
+        if state_dict is not None:
+            model = quantize_model(model_class().eval())
+            model.load_state_dict(state_dict)
+            return optimize_model(model, quantize=False, script=script)
+
+        model = optimize_model(_load_model(model_class, state_dict_path), quantize=True)
+        model_cache.save_prepared_state_dict(
+            state_dict_path, "quantized", model.state_dict())
+        quantize = False
+    else:
+        model = model_class()
+        _load_state_dict(model, model_cache.load_state_dict(state_dict_path))
+        model.eval()
+
+    if quantize or script:
+        model = optimize_model(model, quantize=quantize, script=script)
+    return model
+
+def load_models(wake_word_model_state_path, speech_recognition_model_state_path,
+        joint_intent_and_slot_model_state_path, language_model_path,
+        quantize=False, script=False, model_cache=None):
+    # Returns everything the listener needs to run inference, so the models can
+    # also be loaded (or stubbed) separately and passed to the listener.
+    # Optionally the models are quantized and/or scripted for faster CPU inference
+    # and if we're given a ModelCache, the prepared models are loaded from it.
+    # Without a wake word model path, e.g. when only transcribing recordings,
+    # the wake word model and its preprocessor are left out.
+    #
+    # The models and the language model don't depend on each other, so we load
+    # them all at the same time
+    def load(model_class, state_dict_path):
+        return _load_cached_model(model_class, state_dict_path, model_cache,
+            quantize=quantize, script=script)
+
+    def load_language_model_decoder():
+        if model_cache is not None:
+            return LanaguageModelDecoder(model_cache.language_model_path(language_model_path))
+        return LanaguageModelDecoder(language_model_path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {
+            "speech_recognition_model": executor.submit(
+                load, SpeechRecognitionModel, speech_recognition_model_state_path),
+            "joint_intent_and_slot_model": executor.submit(
+                load, JointIntentAndSlotsModel, joint_intent_and_slot_model_state_path),
+            "language_model_decoder": executor.submit(load_language_model_decoder)}
+        if wake_word_model_state_path is not None:
+            futures["wake_word_detection_model"] = executor.submit(
+                load, WakeWordDetectionModel, wake_word_model_state_path)
+
+        models = {name: future.result() for name, future in futures.items()}
+
+    if wake_word_model_state_path is not None:
+        models["wake_word_preprocessor"] = WakeWordPreprocessor()
+    models["speech_recognition_preprocessor"] = SpeechRecognitionPreprocessor()
+    return models
+
+def _infer_intents_and_slots(model, texts):
+    # Hands all of the language model results to the model at once, if it has
+    # an `inferIntentsAndSlots` that takes a list of them, otherwise infers them
+    # one at a time. Either way returns a list of (confidence, intent, slots).
+    # NOTE: Whether that's actually a single padded forward pass is up to the
+    # model, this only saves us the per result calls.
+    infer_batch = getattr(model, "inferIntentsAndSlots", None)
+    if infer_batch:
+        return infer_batch(texts)
+
+    return [model.inferIntentAndSlots(text) for text in texts]
+
 class Listener(object):
     def __init__(self, wake_word_model_state_path, speech_recognition_model_state_path,
             joint_intent_and_slot_model_state_path, language_model_path,
-            wake_notification_wav_path, intent_handler, synthesize_func=None):
+            wake_notification_wav_path, intent_handler, synthesize_func=None,
+            max_queued_chunks=20, vad_hangover=.5, max_command_duration=4,
+            num_top_results=5, streaming_recognition=False,
+            input_stream=None, models=None, metrics=None,
+            max_in_flight_intents=2, intent_timeout=15, intent_timeouts=None,
+            input_device_index=None, output_device_index=None, name=None):
         self.intent_handler = intent_handler
         self.synthesize_func = synthesize_func
 
-        self.pyaudio = pyaudio.PyAudio()
-        self.stream = self.pyaudio.open(
-            format=pyaudio.paFloat32,channels=1,
-            rate=8000,input=True)
-
-        # Load models
-        self.wake_word_detection_model = _load_model(
-            WakeWordDetectionModel, wake_word_model_state_path)
-        self.speech_recognition_model = _load_model(
-            SpeechRecognitionModel, speech_recognition_model_state_path)
-        self.joint_intent_and_slot_model = _load_model(
-            JointIntentAndSlotsModel, joint_intent_and_slot_model_state_path)
-
-        self.wake_word_preprocessor = WakeWordPreprocessor()
-        self.speech_recognition_preprocessor = SpeechRecognitionPreprocessor()
-        self.language_model_decoder = LanaguageModelDecoder(language_model_path)
+        # When serving several rooms, the name tells them apart
+        self.name = name
+
+        # The intents are handled, and their responses spoken, on separate
+        # threads, so we can still hear the wake and stop words in the meantime.
+        # Each intent gets `intent_timeout` seconds, unless `intent_timeouts`
+        # has a specific timeout for it.
+        self.intent_dispatcher = IntentDispatcher(max_in_flight_intents)
+        self.intent_timeout = intent_timeout
+        self.intent_timeouts = intent_timeouts or {}
+        self._synthesize_parameters = inspect.signature(synthesize_func).parameters\
+            if synthesize_func is not None else {}
+
+        # Timings of each stage and counters of what's happened, which are
+        # disabled unless we're given a Metrics object to record them in
+        self.metrics = metrics or Metrics(enabled=False)
+
+        # Unless we're given a stream to read from, open one to the mic
+        # pyaudio is only imported when we need it, so replaying recordings
+        # works without it
+        self.pyaudio = None
+        self.stream = input_stream
+        if self.stream is None:
+            import pyaudio
+            self.pyaudio = get_pyaudio()
+            self.stream = self.pyaudio.open(
+                format=pyaudio.paFloat32,channels=1,
+                rate=8000,input=True,frames_per_buffer=CHUNK_SIZE,
+                input_device_index=input_device_index)
+
+        # The mic is read on a separate thread, so we don't miss any audio
+        # while we're busy processing a chunk
+        self.audio_capture = AudioCapture(
+            self.stream, CHUNK_SIZE, max_queued_chunks)
+
+        # Load models, unless they've already been loaded for us
+        if models is None:
+            models = load_models(wake_word_model_state_path,
+                speech_recognition_model_state_path,
+                joint_intent_and_slot_model_state_path, language_model_path)
+
+        self.wake_word_detection_model = models["wake_word_detection_model"]
+        self.speech_recognition_model = models["speech_recognition_model"]
+        self.joint_intent_and_slot_model = models["joint_intent_and_slot_model"]
+        self.wake_word_preprocessor = models["wake_word_preprocessor"]
+        self.speech_recognition_preprocessor = models["speech_recognition_preprocessor"]
+        self.language_model_decoder = models["language_model_decoder"]
+        self.num_top_results = num_top_results
         self._initial_hidden, self._initial_c0 = [
             x for x in self.speech_recognition_model.get_initial_hidden(1)]
 
+        # Optionally run the speech recognition model on each chunk as it comes
+        # in, rather than on the whole voice command once it's recorded
+        self.streaming_recognizer = None
+        if streaming_recognition:
+            if supports_streaming(self.speech_recognition_model):
+                self.streaming_recognizer = StreamingRecognizer(
+                    self.speech_recognition_model,
+                    self.speech_recognition_preprocessor, CHUNK_SIZE, self.metrics)
+            else:
+                print("Error in Listener: The speech recognition model doesn't "
+                      "support streaming recognition, falling back to recognizing "
+                      "the whole voice command at once")
+
         # While listening, we are passing each buffer through a
         # wake word detection neural net. If that detects the wake
         # word then we start recording chunks that will be given
         # to the speech recognition neural net
+        # Both buffers are preallocated ring buffers, so we don't allocate new
+        # tensors for every chunk we record
+        # NOTE: The command is recorded a whole chunk at a time, so its maximum
+        # length is rounded up to whole chunks, otherwise the last chunk would
+        # wrap around and overwrite the start of the command
+        max_command_samples = -(-int(8000 * max_command_duration) // CHUNK_SIZE) * CHUNK_SIZE
         self.recording_speech = False
-        self.speech_buffer = torch.tensor([])
-        self.wake_buffer = torch.tensor([])
+        self.speech_buffer = RingBuffer(max_command_samples)
+        self.wake_buffer = RingBuffer(WAKE_WINDOW_SIZE)
+
+        # We keep the peaks of the chunks in the wake window, so we don't have to
+        # rescan the whole window to normalize it, and cache the features of the
+        # window, so we only compute the ones that depend on the new chunk
+        # NOTE: This assumes the window is a whole number of chunks
+        self.wake_peak_tracker = WindowPeakTracker(WAKE_WINDOW_SIZE // CHUNK_SIZE)
+        self.wake_feature_cache = WakeFeatureCache(self.wake_word_preprocessor,
+            WAKE_WINDOW_SIZE, WAKE_PADDED_WINDOW_SIZE, CHUNK_SIZE)
+
+        # Most of the time there's nothing but background noise, so we only run
+        # the wake word detection on windows that are louder than that
+        self.wake_energy_gate = EnergyGate(WAKE_WINDOW_SIZE // CHUNK_SIZE)
+
+        # The voice activity detector tells us when the voice command has
+        # finished, up to a maximum of `max_command_duration` seconds
+        self.voice_activity_detector = VoiceActivityDetector(
+            hangover=vad_hangover, max_duration=max_command_samples / 8000)
+        self.end_of_speech_time = None
 
         # Store the length of the wake notification sound file in seconds
-        wake_notification_wavfile = wave.open(wake_notification_wav_path)
-        self.wake_notification_wave_duration =\
-            wake_notification_wavfile.getnframes() / wake_notification_wavfile.getframerate()
-        wake_notification_wavfile.close()
+        # NOTE: Without a wake notification, we don't play anything on waking up
+        # The notification is decoded into memory up front, so it can start
+        # playing as soon as we wake up
+        self.wake_notification_wave_duration = 0
+        self.audio_output = get_audio_output(output_device_index)
+        if wake_notification_wav_path:
+            self.wake_notification_wave_duration = self.audio_output.load_clip(
+                wake_notification_wav_path).shape[0] / self.audio_output.frame_rate
         self.wake_notification_wav_path = wake_notification_wav_path
 
-    def play_wake_notification(self):
-        wake_notification_wavfile = wave.open(self.wake_notification_wav_path)
+        # The beginning of each voice command recording contains some of the
+        # wake word and the wake notification, so we ignore it
+        self.ignored_speech_samples = self._notification_samples()
 
-        # Create an output pyaudio stream to play the notification sound
-        stream = self.pyaudio.open(
-            format=pyaudio.get_format_from_width(wake_notification_wavfile.getsampwidth()),
-            channels=wake_notification_wavfile.getnchannels(),
-            rate=wake_notification_wavfile.getframerate(),
-            output=True)
+    def _notification_samples(self):
+        # The notification is played while we're already recording, so we
+        # ignore all of it, as well as the time it takes to reach the speakers
+        if not self.wake_notification_wav_path:
+            return 0
+        return int((self.wake_notification_wave_duration +
+            self.audio_output.output_latency) * 8000)
 
-        data = wake_notification_wavfile.readframes(1024)
-        while data:
-            stream.write(data)
-            data = wake_notification_wavfile.readframes(1024)
+    def play_wake_notification(self):
+        if not self.wake_notification_wav_path:
+            return
 
-        stream.close()
-        wake_notification_wavfile.close()
+        # This doesn't wait for the notification to finish playing, so we start
+        # recording the command straight away. The mic still picks up the
+        # notification, which is why we ignore the start of the recording.
+        # Now that the output stream is open, we know its actual latency.
+        self.audio_output.play(self.wake_notification_wav_path)
+        self.ignored_speech_samples = self._notification_samples()
 
-    def start(self):
+    def reset(self):
         self.recording_speech = False
-        self.speech_buffer = torch.tensor([])
-        self.wake_buffer = torch.tensor([])
+        self.speech_buffer.clear()
+        self.wake_buffer.clear()
+        self.wake_peak_tracker.clear()
+        self.wake_feature_cache.reset()
+        self.wake_energy_gate.clear()
+
+    def start(self):
+        self.reset()
+        self.audio_capture.start()
+        dropped_chunk_count = 0
 
         while True:
             try:
-                current_chunk = bytearray(self.stream.read(4000))
-
-                with torch.no_grad():
+                # Use a timeout, so we don't block indefinitely if the mic stops
+                # giving us audio
+                current_chunk = self.audio_capture.read(timeout=1)
+                if current_chunk is None:
+                    # The capture gives up if the mic keeps failing
+                    if not self.audio_capture.is_running():
+                        print("Error in Listener.start: Stopped capturing from the mic, "
+                              "exiting listener..")
+                        self.cleanup()
+                        break
+                    continue
+
+                with torch.no_grad(), self.metrics.time("process_chunk"):
                     self.process_chunk(current_chunk)
 
+                # Let us know if we're falling behind real time
+                if self.audio_capture.dropped_chunk_count > dropped_chunk_count:
+                    self.metrics.increment("dropped_chunks",
+                        self.audio_capture.dropped_chunk_count - dropped_chunk_count)
+                    dropped_chunk_count = self.audio_capture.dropped_chunk_count
+                    print("Warning in Listener.start: Processing is falling behind "
+                          "the mic, %i chunks have been dropped so far" %
+                          dropped_chunk_count)
+
             except KeyboardInterrupt as e:
                 print("KeyboardInterrupt detected, exiting listener..")
                 self.cleanup()
                 break
 
-    def process_chunk(self, chunk):
+        # The output engine and pyaudio are shared with the intent handler and
+        # the voice synthesizer, so they're only shut down once we're done
+        shutdown_audio()
+
+    def add_chunk(self, chunk):
         torch_chunk = torch.frombuffer(chunk, dtype=torch.float32)
 
-        self.wake_buffer = torch.cat((self.wake_buffer, torch_chunk))
+        self.wake_buffer.extend(torch_chunk)
+        self.wake_peak_tracker.update(torch_chunk)
+        self.wake_energy_gate.update(torch_chunk)
+        return torch_chunk
+
+    def wake_word_features(self):
+        with self.metrics.time("wake_word_features"):
+            return self.wake_feature_cache(self.wake_buffer.latest(),
+                self.wake_peak_tracker.peak, self.wake_buffer.total_samples)
+
+    def process_chunk(self, chunk):
+        torch_chunk = self.add_chunk(chunk)
 
         # Check if we have 1.5 seconds of recording
-        # 8000 is sample rate
-        # 1.5 is a second and a half
-        if len(self.wake_buffer) < 8000 * 1.5:
+        if not self.wake_buffer.is_full():
             return
 
-        # Normalize gain
-        normalized_wake_buffer, _ = torchaudio.sox_effects.apply_effects_tensor(
-            self.wake_buffer.unsqueeze(0), 8000, [["gain", "-n"]])
-
         # Wake word
         # The wake word model has been trained on samples that are 3 seconds long
         # so we can train it to ignore a lot of background chatter. Both the
         # wake word and the stop word, though, take far less than that to say
         # so we're essentially running the wake word detection on a recording of
-        # 1.5 seconds, but we pad it with zeros to 3 seconds
-        padded_wake_buffer = torch.cat(
-            (normalized_wake_buffer[0], torch.zeros(12000))).unsqueeze(0)
-        wake_word_action = ["wake","stop","pass"][
-            self.wake_word_detection_model.classify(
-                self.wake_word_preprocessor(padded_wake_buffer)).item()]
-
-        # Clear the old samples from the buffer, so we always keep it to the last
-        # second
-        self.wake_buffer = self.wake_buffer[-8000 * 1:]
-
+        # 1.5 seconds, but we pad it with zeros to 3 seconds.
+        # The feature cache takes care of both normalizing the gain and padding.
+        # If the window is just background noise, we don't run the model at all
+        wake_word_action = "pass"
+        if self.wake_energy_gate.is_open():
+            self.metrics.increment("evaluated_wake_windows")
+            with self.metrics.time("wake_word_detection"):
+                wake_word_action = WAKE_WORD_ACTIONS[
+                    self.wake_word_detection_model.classify(
+                        self.wake_word_features()).item()]
+        else:
+            self.metrics.increment("gated_wake_windows")
+
+        # NOTE: There's no need to clear the old samples from the wake buffer, as
+        # the ring buffer only ever keeps the last second and a half, so the next
+        # chunk will simply overwrite the oldest half a second
+
+        self.process_wake_word_action(torch_chunk, wake_word_action)
+
+    def process_wake_word_action(self, torch_chunk, wake_word_action):
+        # Everything after the wake word detection, which is split out, so the
+        # MultiStreamListener can run the detection of all streams in one batch
         if wake_word_action == "wake":
             if not self.recording_speech:
                 # If we've detected the wake word and we're currently idle
                 # (not recording speech) then switch to recording speech mode
+                self.metrics.increment("wakes")
                 self.play_wake_notification()
                 self.recording_speech = True
-                self.speech_buffer = torch.tensor([])
+                self.speech_buffer.clear()
+                self.voice_activity_detector.reset(self.ignored_speech_samples)
+                if self.streaming_recognizer:
+                    self.streaming_recognizer.reset(self.ignored_speech_samples)
                 return
         elif wake_word_action == "stop":
+            # The stop word also cancels any intents that are still being
+            # handled or spoken
+            cancelled_intents = self.intent_dispatcher.cancel_all()
+            self.metrics.increment("cancelled_intents", cancelled_intents)
+
             if self.recording_speech:
                 # If we've detected the stop word and we're currently recording
                 # speech, then stop, which switches us back to idle mode
+                self.metrics.increment("stops")
                 self.recording_speech = False
                 return
 
+            # A stop word while we're idle and not doing anything is a false detection
+            if not cancelled_intents:
+                self.metrics.increment("false_stops")
+
         # Speech recognition
         # We keep a separate buffer for the speech recognition, so we can
         # easily impose different rules about their sizes. The process
         # is very similar to the wake word where we:
         # - append the current recorded chunk to the buffer
-        # - normalize the gain across the whole buffer (in a copy, so we
-        #   avoid normalizing the same chunk multiple times)
+        # - normalize the gain across the whole buffer (in place, as unlike
+        #   the wake buffer, each chunk is only ever normalized once)
         # - get the raw speech recognition outputs from the model
         # - pass them through a ctc beam search
         # - pass the top 5 results from the ctc search through the intents
         #   and slots models
         # - pick the one result that has the highest intent classification
         #   confidence
-        if self.recording_speech:
-            self.speech_buffer = torch.cat((self.speech_buffer, torch_chunk))
-
-            # Stop recording speech after 4 seconds
-            # NOTE: This is what needs to be replaced with voice activity detection
-            if self.speech_buffer.shape[0] >= 8000 * 4:
-                self.recording_speech = False
+        if not self.recording_speech:
+            # Keep track of the background noise while idle, so the voice
+            # activity detector knows what silence sounds like
+            self.voice_activity_detector.update_noise_floor(torch_chunk)
+        else:
+            self.speech_buffer.extend(torch_chunk)
+
+            # Stop recording speech once the voice activity detector tells us
+            # the command is finished
+            if not self.voice_activity_detector.process(torch_chunk):
+                if self.streaming_recognizer:
+                    with self.metrics.time("speech_recognition"):
+                        self.streaming_recognizer.push(self.speech_buffer.latest())
+                return
 
+            self.recording_speech = False
+            self.end_of_speech_time = self.voice_activity_detector.end_of_speech_time
+            self.metrics.increment("commands")
+            self.metrics.observe("command_duration",
+                self.speech_buffer.total_samples / 8000)
+            speech_buffer = self.speech_buffer.latest()
+
+            if self.streaming_recognizer:
+                with self.metrics.time("speech_recognition"):
+                    raw_speech_recognition_output = self.streaming_recognizer.finish(
+                        speech_buffer)
+            else:
                 # Strip the first few frames, as otherwise we pick up some of the
                 # wake word and also the wake notification
                 # NOTE: It appears that just zeroing out those samples rather than
                 # cutting them outright helps with the speech recognition, presumably
                 # because most of my recorded samples have a bit of a gap in the beginning
-                self.speech_buffer[
-                    :int((self.wake_notification_wave_duration*.75) * 8000)] *= 0
+                speech_buffer[:self.ignored_speech_samples] *= 0
 
                 # Normalize gain
-                normalized_speech_buffer, _ = torchaudio.sox_effects.apply_effects_tensor(
-                    self.speech_buffer.unsqueeze(0), 8000, [["gain", "-n"]])
+                # NOTE: We can do this in place, as the speech buffer gets cleared
+                # before we start recording the next command
+                with self.metrics.time("speech_normalization"):
+                    normalized_speech_buffer = normalize_peak(speech_buffer).unsqueeze(0)
 
                 #normalized_speech_buffer = torch.cat((normalized_speech_buffer[0], torch.zeros(12000))).unsqueeze(0)
 
-                raw_speech_recognition_output = self.speech_recognition_model.recognize(
-                    self.speech_recognition_preprocessor(normalized_speech_buffer),
-                    self._initial_hidden, self._initial_c0)
+                with self.metrics.time("speech_recognition"):
+                    raw_speech_recognition_output = self.speech_recognition_model.recognize(
+                        self.speech_recognition_preprocessor(normalized_speech_buffer),
+                        self._initial_hidden, self._initial_c0)
 
+            with self.metrics.time("language_model_decode"):
                 top_language_model_results = self.language_model_decoder.decode(
-                    raw_speech_recognition_output, num_top_results=5)
-
-                # Intents and slots
-                # NOTE: Make it so we prefer having slots and we prefer
-                # not having the PAD slot
-                highest_confidence = 0
-                most_confident_intent = -1
-                most_confident_result = None
-                most_confident_slots = []
-                for result in top_language_model_results:
-                    confidence, intent, slots = self.joint_intent_and_slot_model.\
-                        inferIntentAndSlots(result)
-
-                    if confidence > highest_confidence:
-                        highest_confidence = confidence
-                        most_confident_intent = intent
-                        most_confident_result = result
-                        most_confident_slots = slots
-
-                print(most_confident_result, "||", most_confident_intent,
-                    "||", highest_confidence, "||", most_confident_slots)
-
-                self.process_intent(most_confident_intent, most_confident_slots)
-                #torchaudio.save("tmp.wav", normalized_speech_buffer, 8000)
-
-                #import string
-                #arg_maxes = torch.argmax(raw_speech_recognition_output[0], dim=1)
-                #LABELS = {letter:i+2 for i, letter in enumerate(string.ascii_lowercase)}
-                #LABELS[' '] = 1
-                #LABELS['_'] = 0
-                #LABEL_INDICES = {v:k for k,v in LABELS.items()}
-                #no_ctc_output = ''.join([LABEL_INDICES[int(x)] for x in arg_maxes if x != 0])
-                #print(no_ctc_output)
+                    raw_speech_recognition_output, num_top_results=self.num_top_results)
+
+            # Intents and slots
+            # NOTE: Make it so we prefer having slots and we prefer
+            # not having the PAD slot
+            highest_confidence = 0
+            most_confident_intent = -1
+            most_confident_result = None
+            most_confident_slots = []
+            with self.metrics.time("intent_inference"):
+                inferred_intents_and_slots = _infer_intents_and_slots(
+                    self.joint_intent_and_slot_model, top_language_model_results)
+            for result, (confidence, intent, slots) in zip(
+                    top_language_model_results, inferred_intents_and_slots):
+                if confidence > highest_confidence:
+                    highest_confidence = confidence
+                    most_confident_intent = intent
+                    most_confident_result = result
+                    most_confident_slots = slots
+
+            if self.name:
+                print("[%s]" % self.name, end=" ")
+            print(most_confident_result, "||", most_confident_intent,
+                "||", highest_confidence, "||", most_confident_slots)
+
+            self.process_intent(most_confident_intent, most_confident_slots)
+            #torchaudio.save("tmp.wav", normalized_speech_buffer, 8000)
+
+            #import string
+            #arg_maxes = torch.argmax(raw_speech_recognition_output[0], dim=1)
+            #LABELS = {letter:i+2 for i, letter in enumerate(string.ascii_lowercase)}
+            #LABELS[' '] = 1
+            #LABELS['_'] = 0
+            #LABEL_INDICES = {v:k for k,v in LABELS.items()}
+            #no_ctc_output = ''.join([LABEL_INDICES[int(x)] for x in arg_maxes if x != 0])
+            #print(no_ctc_output)
 
     def process_intent(self, intent, slots):
         handler = getattr(self.intent_handler, intent.replace(".","_"), None)
         if not handler:
-            print("ERROR in Kronos.process_intent: "
+            print("Error in Listener.process_intent: "
                   "The intent %s doesn't have a handler." % intent)
+            self.metrics.increment("unhandled_intents")
+            return
+
+        end_of_speech_time = self.end_of_speech_time
+        self.end_of_speech_time = None
+
+        name = intent.replace(".","_")
+        submitted = self.intent_dispatcher.submit(name,
+            lambda cancel_event: self._handle_intent(
+                handler, slots, end_of_speech_time, cancel_event),
+            self.intent_timeouts.get(name, self.intent_timeout))
+
+        if not submitted:
+            print("Error in Listener.process_intent: Too many intents are already "
+                  "being handled, ignoring %s." % intent)
+            self.metrics.increment("rejected_intents")
+
+    def _handle_intent(self, handler, slots, end_of_speech_time, cancel_event):
+        with self.metrics.time("intent_handler"):
+            response = handler(slots)
+
+        # We might have been cancelled by the stop word or timed out in the meantime
+        if cancel_event.is_set():
             return
 
-        response = handler(slots)
+        if end_of_speech_time:
+            latency = time.time() - end_of_speech_time
+            print("End of speech to response latency: %.2fs" % latency)
+            self.metrics.observe("end_of_speech_to_response", latency)
 
         if response:
             if self.synthesize_func:
-                self.synthesize_func(response)
+                # Only pass the optional arguments the synthesizer supports
+                kwargs = {key: value for key, value in [
+                        ("cancel_event", cancel_event), ("audio_output", self.audio_output)]
+                    if key in self._synthesize_parameters}
+                with self.metrics.time("voice_synthesis"):
+                    timings = self.synthesize_func(response, **kwargs)
+
+                # The synthesizer can report its own timings, like the time to
+                # first audio
+                if isinstance(timings, dict):
+                    for stage, seconds in timings.items():
+                        self.metrics.observe(stage, seconds)
             else:
-                print("Kronos:", response)
+                print("Kronos (%s):" % self.name if self.name else "Kronos:", response)
 
     def cleanup(self):
-        pass
+        # Stops everything that belongs to this listener. The audio output is
+        # shared, so it's left to whoever started us to shut it down.
+        self.intent_dispatcher.shutdown()
+        self.audio_capture.stop(timeout=1)
+        self.stream.stop_stream()
+        self.stream.close()
 
 if __name__ == "__main__":
     class DummyIntentHandler():
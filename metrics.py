@@ -0,0 +1,155 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = [.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5, 10, float("inf")]
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): count
+                for bound, count in zip(self.buckets, self.bucket_counts)}}
+
+
+class _Timer(object):
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    # Per stage timing histograms and counters for the voice pipeline.
+    #
+    # When disabled, timing a stage returns a shared no-op context manager and
+    # incrementing a counter returns straight away, so the instrumentation can
+    # stay in the code at practically no cost.
+    #
+    # Usage:
+    #   with metrics.time("speech_recognition"):
+    #       ...
+    #   metrics.increment("wakes")
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._server = None
+
+    def time(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, counter, count=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime": time.time() - self.start_time,
+                "counters": dict(self.counters),
+                "stages": {stage: histogram.snapshot()
+                    for stage, histogram in self.histograms.items()}}
+
+    def start_periodic_dump(self, interval, path=None):
+        # Every `interval` seconds, prints the metrics as json, or writes them to
+        # `path` if given
+        def dump():
+            while True:
+                time.sleep(interval)
+                snapshot = json.dumps(self.snapshot())
+                if path:
+                    with open(path, "w") as f:
+                        f.write(snapshot)
+                else:
+                    print("Metrics:", snapshot)
+
+        threading.Thread(target=dump, daemon=True).start()
+
+    def start_server(self, port, host="127.0.0.1"):
+        # Serves the metrics as json on http://host:port/metrics, so they can be
+        # scraped locally
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = json.dumps(metrics.snapshot()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address
+
+    def stop_server(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import torch
+
+
+# A cache of ready to run model artifacts, so starting Kronos doesn't have to
+# parse the same files over and over again. The artifacts are keyed by the hash
+# of the file they've been prepared from, so changing a model invalidates them.
+#
+# It holds
+# - state dicts re-saved in torch's zipfile format, which can be memory mapped
+#   rather than read into memory up front
+# - state dicts of the quantized models, so we don't quantize on every start
+# - binary versions of the arpa language model, which load much faster, if
+#   kenlm's `build_binary` is available
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "kronos")
+
+
+def _load(path):
+    # Memory map the file if this version of torch supports it. These are files we
+    # wrote ourselves and the quantized ones contain packed weights, which are not
+    # plain tensors, so we don't restrict the loading to weights only.
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location="cpu")
+
+
+def _save(obj, path):
+    # Write to a temporary file first, so a crash never leaves half an artifact
+    tmp_path = "%s.%i.tmp" % (path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class ModelCache(object):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Hashing a large file takes a while, so we remember the hashes of the
+        # files we've seen, keyed by their path, size and modification time
+        self._hashes_path = os.path.join(cache_dir, "hashes.json")
+        self._hashes_lock = threading.Lock()
+        try:
+            with open(self._hashes_path) as f:
+                self._hashes = json.load(f)
+        except (IOError, ValueError):
+            self._hashes = {}
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = "%s:%i:%i" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+        with self._hashes_lock:
+            if key in self._hashes:
+                return self._hashes[key]
+
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                sha1.update(block)
+
+        with self._hashes_lock:
+            self._hashes[key] = sha1.hexdigest()
+            tmp_path = "%s.%i.tmp" % (self._hashes_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(self._hashes, f)
+            os.replace(tmp_path, self._hashes_path)
+
+        return self._hashes[key]
+
+    def artifact_path(self, source_path, kind, extension=".torch"):
+        # `kind` distinguishes different artifacts prepared from the same file
+        return os.path.join(self.cache_dir, "%s.%s.%s%s" % (
+            self.file_hash(source_path), kind, torch.__version__, extension))
+
+    def load_state_dict(self, state_dict_path):
+        cached_path = self.artifact_path(state_dict_path, "state_dict")
+        if os.path.exists(cached_path):
+            return _load(cached_path)
+
+        state_dict = torch.load(state_dict_path, map_location="cpu")
+        _save(state_dict, cached_path)
+        return state_dict
+
+    def load_prepared_state_dict(self, state_dict_path, kind):
+        # Returns the state dict of a model prepared from the given file, e.g. a
+        # quantized one, or None if we haven't cached one yet
+        cached_path = self.artifact_path(state_dict_path, kind)
+        return _load(cached_path) if os.path.exists(cached_path) else None
+
+    def save_prepared_state_dict(self, state_dict_path, kind, state_dict):
+        _save(state_dict, self.artifact_path(state_dict_path, kind))
+
+    def language_model_path(self, language_model_path):
+        # Returns the path to a binary version of an arpa language model, or the
+        # original path if it's not an arpa file or we can't build one
+        if not language_model_path.endswith(".arpa"):
+            return language_model_path
+
+        build_binary = shutil.which("build_binary")
+        if not build_binary:
+            return language_model_path
+
+        binary_path = self.artifact_path(language_model_path, "language_model", ".binary")
+        if os.path.exists(binary_path):
+            return binary_path
+
+        tmp_path = "%s.%i.tmp" % (binary_path, os.getpid())
+        try:
+            subprocess.run([build_binary, language_model_path, tmp_path],
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("Error in ModelCache.language_model_path: Could not build a binary "
+                  "language model, using the arpa file instead - ", e)
+            return language_model_path
+
+        os.replace(tmp_path, binary_path)
+        return binary_path
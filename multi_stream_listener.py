@@ -0,0 +1,179 @@
+import threading
+import torch
+
+from listener import Listener, load_models, WAKE_WORD_ACTIONS, WAKE_PADDED_WINDOW_SIZE
+from metrics import Metrics
+from audio_output import shutdown as shutdown_audio
+
+
+# Serves several microphones (e.g. one per room) from a single process.
+#
+# Each stream gets its own Listener, which keeps its own buffers, voice
+# activity detector and idle/recording state, as well as its own intent
+# dispatcher and audio output, so the stop word in one room only cancels what's
+# being said in that room and responses are played where they were asked for.
+# The models, though, are loaded once and shared by all of them, so memory
+# stays roughly flat as we add streams.
+#
+# On every chunk, the wake word windows of all streams that aren't gated as
+# background noise are stacked and classified in a single batch, rather than
+# with a forward pass per stream.
+#
+# NOTE: Everything after the wake word detection (e.g. recognizing a command)
+# still runs one stream at a time, on this thread. The mics are read on their
+# own threads, so no audio is lost in the meantime.
+
+
+def supports_batched_classify(model, preprocessor):
+    # Checks, on a couple of silent windows, whether the model returns a class
+    # per window when given a batch of them
+    features = preprocessor(torch.zeros(1, WAKE_PADDED_WINDOW_SIZE))
+    try:
+        with torch.no_grad():
+            classes = model.classify(torch.cat((features, features)))
+    except RuntimeError:
+        return False
+    return classes.reshape(-1).shape[0] == 2
+
+
+def _classify_wake_words(model, features, batched=True):
+    # Returns the class of each of the wake word windows, classifying them all
+    # in one batch, or one by one if the model doesn't support that
+    if batched:
+        return model.classify(torch.cat(features)).reshape(-1).tolist()
+
+    return [model.classify(window_features).item() for window_features in features]
+
+
+class MultiStreamListener(object):
+    # `streams` is a list of dicts of the keyword arguments specific to each
+    # stream's Listener, e.g.
+    #   [{"name": "kitchen", "input_device_index": 1, "output_device_index": 3},
+    #    {"name": "bedroom", "input_device_index": 2, "output_device_index": 4}]
+    # Everything else is passed to all of them.
+    def __init__(self, wake_word_model_state_path, speech_recognition_model_state_path,
+            joint_intent_and_slot_model_state_path, language_model_path,
+            wake_notification_wav_path, intent_handler, synthesize_func=None,
+            streams=None, models=None, metrics=None, **kwargs):
+        self.metrics = metrics or Metrics(enabled=False)
+
+        # Load models once, unless they've already been loaded for us
+        if models is None:
+            models = load_models(wake_word_model_state_path,
+                speech_recognition_model_state_path,
+                joint_intent_and_slot_model_state_path, language_model_path)
+        self.wake_word_detection_model = models["wake_word_detection_model"]
+
+        # Whether the model can classify a batch of windows is checked once, up
+        # front, rather than on every chunk
+        self.batched_wake_word_detection = supports_batched_classify(
+            self.wake_word_detection_model, models["wake_word_preprocessor"])
+        if not self.batched_wake_word_detection:
+            print("Error in MultiStreamListener: The wake word detection model doesn't "
+                  "classify batches of windows, falling back to one window at a time")
+
+        self.listeners = []
+        for i, stream_kwargs in enumerate(streams or [{}]):
+            stream_kwargs = dict(kwargs, **stream_kwargs)
+            stream_kwargs.setdefault("name", str(i))
+            self.listeners.append(Listener(wake_word_model_state_path,
+                speech_recognition_model_state_path,
+                joint_intent_and_slot_model_state_path, language_model_path,
+                wake_notification_wav_path, intent_handler, synthesize_func,
+                models=models, metrics=self.metrics, **stream_kwargs))
+
+    def start(self):
+        # All the captures signal the same event when they've queued a chunk, so
+        # we wake up as soon as any of the mics has audio for us
+        chunk_ready = threading.Event()
+        for listener in self.listeners:
+            listener.reset()
+            listener.audio_capture.ready_event = chunk_ready
+            listener.audio_capture.start()
+
+        dropped_chunk_count = 0
+
+        while True:
+            try:
+                # Use a timeout, so we notice if all the mics stop giving us audio
+                if not chunk_ready.wait(timeout=1):
+                    if not any(listener.audio_capture.is_running()
+                            for listener in self.listeners):
+                        print("Error in MultiStreamListener.start: Stopped capturing "
+                              "from all the mics, exiting listener..")
+                        self.cleanup()
+                        break
+                    continue
+
+                # Clear the event before draining the queues, so a chunk that
+                # comes in while we're processing wakes us up again
+                chunk_ready.clear()
+                queued_chunks = [(listener, listener.audio_capture.drain())
+                    for listener in self.listeners]
+
+                # Process whatever has been queued in rounds of at most one chunk
+                # per mic, so the wake word windows can still be batched, and
+                # we catch up with all the mics without waiting on any of them
+                for round_index in range(max(len(chunks) for _, chunks in queued_chunks)):
+                    chunks = [(listener, chunks[round_index])
+                        for listener, chunks in queued_chunks if round_index < len(chunks)]
+
+                    with torch.no_grad(), self.metrics.time("process_chunks"):
+                        self.process_chunks(chunks)
+
+                # Let us know if we're falling behind real time
+                total_dropped_chunk_count = sum(listener.audio_capture.dropped_chunk_count
+                    for listener in self.listeners)
+                if total_dropped_chunk_count > dropped_chunk_count:
+                    self.metrics.increment("dropped_chunks",
+                        total_dropped_chunk_count - dropped_chunk_count)
+                    dropped_chunk_count = total_dropped_chunk_count
+                    print("Warning in MultiStreamListener.start: Processing is falling "
+                          "behind the mics, %i chunks have been dropped so far" %
+                          dropped_chunk_count)
+
+            except KeyboardInterrupt as e:
+                print("KeyboardInterrupt detected, exiting listener..")
+                self.cleanup()
+                break
+
+    def process_chunks(self, chunks):
+        # `chunks` is a list of (listener, chunk), with at most one chunk per
+        # listener
+        ready = []
+        evaluated = []
+        for listener, chunk in chunks:
+            torch_chunk = listener.add_chunk(chunk)
+
+            # Check if we have 1.5 seconds of recording
+            if not listener.wake_buffer.is_full():
+                continue
+            ready.append((listener, torch_chunk))
+
+            if listener.wake_energy_gate.is_open():
+                evaluated.append(listener)
+            else:
+                self.metrics.increment("gated_wake_windows")
+
+        # Run the wake word detection of all the streams in one batch
+        wake_word_actions = {}
+        if evaluated:
+            self.metrics.increment("evaluated_wake_windows", len(evaluated))
+            self.metrics.increment("wake_word_batches")
+            with self.metrics.time("wake_word_detection"):
+                classes = _classify_wake_words(self.wake_word_detection_model,
+                    [listener.wake_word_features() for listener in evaluated],
+                    self.batched_wake_word_detection)
+            wake_word_actions = {listener: WAKE_WORD_ACTIONS[class_index]
+                for listener, class_index in zip(evaluated, classes)}
+
+        for listener, torch_chunk in ready:
+            listener.process_wake_word_action(torch_chunk,
+                wake_word_actions.get(listener, "pass"))
+
+    def cleanup(self):
+        # Stop all the streams before shutting down the audio output they share,
+        # so none of them is still speaking through it when it goes away
+        for listener in self.listeners:
+            listener.cleanup()
+        shutdown_audio()
@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import json
+import resource
+import sys
+import time
+import wave
+import torch
+
+from listener import Listener, load_models, CHUNK_SIZE
+from metrics import Metrics
+
+
+# Replays recorded (or synthetic) audio through the listener, without a sound
+# card, and reports how long each stage of the pipeline takes, so we can
+# benchmark and regression test changes to the code or the models.
+
+SAMPLE_RATE = 8000
+
+
+class ReplayStream(object):
+    # A stand-in for the pyaudio input stream, which reads from a tensor of
+    # float32 samples instead of the mic
+    def __init__(self, samples):
+        self.samples = samples
+        self.position = 0
+
+    def read(self, num_frames, exception_on_overflow=True):
+        chunk = self.samples[self.position:self.position + num_frames]
+        self.position += num_frames
+        if chunk.shape[0] < num_frames:
+            chunk = torch.cat((chunk, torch.zeros(num_frames - chunk.shape[0])))
+        return chunk.numpy().tobytes()
+
+    def is_finished(self):
+        return self.position >= self.samples.shape[0]
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayIntentHandler(object):
+    # Records the intents instead of acting on them, so replaying doesn't
+    # set timers or make requests
+    def __init__(self):
+        self.handled_intents = []
+
+    def __getattr__(self, attr):
+        return lambda slots: self.handled_intents.append((attr, slots))
+
+
+class ReplayListener(Listener):
+    # A listener that reads from a ReplayStream and doesn't play anything. Every
+    # stage of the pipeline is timed in its metrics, which are enabled by default.
+    def __init__(self, samples, *args, **kwargs):
+        kwargs["input_stream"] = ReplayStream(samples)
+        kwargs.setdefault("metrics", Metrics(enabled=True))
+        # Handle the intents synchronously, so they're timed as part of the chunk
+        kwargs.setdefault("max_in_flight_intents", 0)
+        super(ReplayListener, self).__init__(*args, **kwargs)
+
+    def play_wake_notification(self):
+        pass
+
+
+def load_wav(path):
+    # Reads an 8kHz mono PCM wav file into a float32 tensor in the [-1, 1] range
+    wavfile = wave.open(path)
+    try:
+        if wavfile.getframerate() != SAMPLE_RATE or wavfile.getnchannels() != 1:
+            raise ValueError("%s is not %iHz mono" % (path, SAMPLE_RATE))
+
+        sample_width = wavfile.getsampwidth()
+        dtype = {1: torch.uint8, 2: torch.int16, 4: torch.int32}.get(sample_width)
+        if dtype is None:
+            raise ValueError("%s has an unsupported sample width" % path)
+
+        data = bytearray(wavfile.readframes(wavfile.getnframes()))
+    finally:
+        wavfile.close()
+
+    samples = torch.frombuffer(data, dtype=dtype).to(torch.float32) if data\
+        else torch.zeros(0)
+    if dtype == torch.uint8:
+        return (samples - 128) / 128
+    return samples / float(2 ** (8 * sample_width - 1))
+
+
+def replay(listener, realtime=False):
+    # Feeds the listener's replay stream through `process_chunk` chunk by chunk,
+    # either as fast as possible or paced to real time, and returns a report
+    stream = listener.stream
+    audio_duration = stream.samples.shape[0] / SAMPLE_RATE
+    chunk_duration = CHUNK_SIZE / SAMPLE_RATE
+
+    start = time.perf_counter()
+    num_chunks = 0
+    while not stream.is_finished():
+        if realtime:
+            time.sleep(max(start + num_chunks * chunk_duration - time.perf_counter(), 0))
+
+        chunk = bytearray(stream.read(CHUNK_SIZE))
+        with torch.no_grad(), listener.metrics.time("process_chunk"):
+            listener.process_chunk(chunk)
+        num_chunks += 1
+    wall_time = time.perf_counter() - start
+
+    metrics = listener.metrics.snapshot()
+    counters = metrics["counters"]
+    processing_time = metrics["stages"].get("process_chunk", {}).get("total", 0)
+    wake_count, command_count = counters.get("wakes", 0), counters.get("commands", 0)
+    recognizer = listener.streaming_recognizer
+    return {
+        "audio_seconds": audio_duration,
+        "wall_seconds": wall_time,
+        "processing_seconds": processing_time,
+        "real_time_factor": processing_time / audio_duration if audio_duration else 0,
+        "chunks": num_chunks,
+        "wakes": wake_count,
+        "commands": command_count,
+        "wakes_per_second": wake_count / wall_time if wall_time else 0,
+        "commands_per_second": command_count / wall_time if wall_time else 0,
+        "gated_windows": listener.wake_energy_gate.gated_count,
+        "evaluated_windows": listener.wake_energy_gate.evaluated_count,
+        "wake_feature_mode": listener.wake_feature_cache.mode,
+        # What restarting the streaming recognition on a louder chunk cost us
+        "streaming_restarts": recognizer.restart_count if recognizer else 0,
+        "streaming_reprocessed_seconds": recognizer.reprocessed_samples / SAMPLE_RATE
+            if recognizer else 0,
+        "streaming_reprocessing_seconds": recognizer.reprocessing_seconds
+            if recognizer else 0,
+        # ru_maxrss is in kilobytes on linux
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": metrics["stages"],
+        "counters": counters,
+        "intents": [intent for intent, _ in listener.intent_handler.handled_intents]
+            if isinstance(listener.intent_handler, ReplayIntentHandler) else []}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay audio through the Kronos listener and benchmark it")
+    parser.add_argument("trained_wake_word_model_path",
+        help="path to the saved state of the trained wake word detection model")
+    parser.add_argument("trained_speech_recognition_model_path",
+        help="path to the saved state of the trained speech recognition model")
+    parser.add_argument("trained_joint_intent_and_slot_model_path",
+        help="path to the saved state of the trained joined intent "
+             "inference and slot filling model")
+    parser.add_argument("language_model_path",
+        help="path to the language model")
+    parser.add_argument("wav_paths", nargs="*",
+        help="8kHz mono wav files to replay, one after the other")
+    parser.add_argument("-wn", "--wake_notification_wav_path",
+        help="path to the wave file that would be played upon waking up, which "
+             "is only used to know how much of each command to ignore")
+    parser.add_argument("-s", "--synthetic_seconds", type=float, default=0,
+        help="replay this many seconds of low level noise instead of wav files")
+    parser.add_argument("-rt", "--realtime", action="store_true",
+        help="feed the audio at real time speed, rather than as fast as possible")
+    parser.add_argument("-sr", "--streaming_recognition", action="store_true",
+        help="whether or not to run the speech recognition on the voice command "
+             "while it's still being recorded")
+    parser.add_argument("-o", "--output",
+        help="path to write the json report to, instead of stdout")
+
+    parsed_args = parser.parse_args()
+
+    # Leave a second of silence between files, so commands don't run into each other
+    samples = []
+    for wav_path in parsed_args.wav_paths:
+        samples += [load_wav(wav_path), torch.zeros(SAMPLE_RATE)]
+    if parsed_args.synthetic_seconds:
+        samples.append(torch.randn(int(SAMPLE_RATE * parsed_args.synthetic_seconds)) * 1e-3)
+    if not samples:
+        parser.error("Either wav_paths or --synthetic_seconds need to be provided")
+
+    models = load_models(parsed_args.trained_wake_word_model_path,
+        parsed_args.trained_speech_recognition_model_path,
+        parsed_args.trained_joint_intent_and_slot_model_path,
+        parsed_args.language_model_path)
+
+    listener = ReplayListener(torch.cat(samples), None, None, None, None,
+        parsed_args.wake_notification_wav_path, ReplayIntentHandler(),
+        streaming_recognition=parsed_args.streaming_recognition, models=models)
+
+    # Keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = json.dumps(replay(listener, parsed_args.realtime), indent=2)
+    if parsed_args.output:
+        with open(parsed_args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import re
+import threading
+
+
+# An on disk cache of synthesized speech, so the responses we give over and
+# over again (and the fixed bits of the ones that vary) don't cost a request to
+# the text to speech service, or the wait for it.
+#
+# The audio is stored in files named after the hash of the text, voice and
+# format it was synthesized with. We bump a file's modification time whenever
+# it's used, so when the cache outgrows its budget we can evict the least
+# recently used files first.
+#
+# Responses can also be composed of segments, given templates like
+# "The current time in %s is %s". A response matching a template is split into
+# its fixed parts, which come from the cache after the first time, and its
+# variable parts, which are cached separately.
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "kronos", "speech")
+DEFAULT_MAX_BYTES = 64 * 2 ** 20
+
+
+def _template_regex(template):
+    # Each format specifier becomes a group matching a variable part
+    parts = re.split(r"%[-+ #0]*\d*(?:\.\d+)?[sdif]", template)
+    return re.compile("^%s$" % "(.+?)".join(re.escape(part) for part in parts))
+
+
+class SpeechCache(object):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.bytes_saved = 0
+
+        self._templates = []
+        self._lock = threading.Lock()
+        self._total_bytes = sum(entry.stat().st_size
+            for entry in os.scandir(cache_dir) if entry.name.endswith(".audio"))
+
+    def key(self, text, voice, accept):
+        return hashlib.sha1(("%s\n%s\n%s" % (voice, accept, text)).encode("utf-8"))\
+            .hexdigest()
+
+    def path(self, text, voice, accept):
+        return os.path.join(self.cache_dir, self.key(text, voice, accept) + ".audio")
+
+    def get(self, text, voice, accept):
+        # Returns the cached audio, or None
+        path = self.path(text, voice, accept)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)
+        except (IOError, OSError):
+            with self._lock:
+                self.miss_count += 1
+            return None
+
+        with self._lock:
+            self.hit_count += 1
+            self.bytes_saved += len(audio)
+        return audio
+
+    def put(self, text, voice, accept, audio):
+        path = self.path(text, voice, accept)
+        tmp_path = "%s.%i.%i.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            print("Error in SpeechCache.put: Could not write %s - " % path, e)
+            return
+
+        with self._lock:
+            self._total_bytes += len(audio)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Expects the lock to be held. Removes the least recently used files
+        # until we're back under budget.
+        entries = sorted((entry for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(".audio")),
+            key=lambda entry: entry.stat().st_mtime)
+
+        self._total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._total_bytes -= size
+
+    def add_templates(self, templates):
+        self._templates += [_template_regex(template) for template in templates]
+
+    def segments(self, text):
+        # Splits the text into the fixed and variable parts of the first template
+        # it matches, or returns it whole if it doesn't match any
+        for template in self._templates:
+            match = template.match(text)
+            if not match:
+                continue
+
+            segments = []
+            position = 0
+            for i in range(1, len(match.groups()) + 1):
+                segments += [text[position:match.start(i)], match.group(i)]
+                position = match.end(i)
+            segments.append(text[position:])
+            return [segment.strip() for segment in segments if segment.strip()]
+        return [text]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hit_count + self.miss_count
+            return {
+                "hits": self.hit_count,
+                "misses": self.miss_count,
+                "hit_ratio": self.hit_count / lookups if lookups else 0,
+                "bytes_saved": self.bytes_saved,
+                "bytes_cached": self._total_bytes}
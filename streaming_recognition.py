@@ -0,0 +1,204 @@
+import time
+import torch
+
+from gain_normalization import normalize_peak, peak_scale
+from wake_features import probe_frames, probe_gain_exponent
+
+
+def supports_streaming(model):
+    return callable(getattr(model, "recognize_chunk", None))
+
+
+class StreamingRecognizer(object):
+    # Runs the speech recognition model on the voice command while it's still
+    # being recorded, carrying the LSTM hidden and cell states from one chunk to
+    # the next, so once the recording finishes all that's left is the decoding.
+    #
+    # It relies on the model implementing
+    #   recognize_chunk(features, hidden, c0) -> (output, hidden, c0)
+    # which is the same as `recognize`, but also returns the final states.
+    #
+    # The features have to be the same as the ones computed over the whole
+    # recording in one go, so, like the WakeFeatureCache, we probe the
+    # preprocessor for its frame hop and receptive field. Each time more audio
+    # comes in, we only compute the frames whose samples have all been
+    # recorded, from a segment that starts early enough to cover their receptive
+    # field, and leave the rest for the next chunk. The last few frames, which
+    # depend on how the recording ends, are only computed in `finish`.
+    #
+    # The gain normalization needs the peak of the whole recording, which we
+    # don't know until it's finished, so we recognize with the peak so far and
+    # if a louder chunk comes in, we start over with the new peak. That way the
+    # recognition is always done at the same gain as the batch path.
+    # If the features scale with the gain (e.g. a spectrogram), they're computed
+    # on the raw audio and only scaled when they're given to the model, so
+    # starting over only re-runs the model, in one call, on the features we
+    # already have. To bound the cost of a command that keeps getting louder,
+    # after `max_restarts` we stop running the model until `finish`, which then
+    # runs it once over the whole command. Either way `finish` never does more
+    # work than recognizing the whole command in one go. The restarts are
+    # counted and timed in `metrics` ("streaming_restarts" and
+    # "streaming_reprocessing") and the commands we gave up streaming on are
+    # counted as "streaming_deferred".
+    def __init__(self, model, preprocessor, chunk_size=4000, metrics=None,
+            max_restarts=2):
+        self.model = model
+        self.preprocessor = preprocessor
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.max_restarts = max_restarts
+
+        # Totals across all commands
+        self.restart_count = 0
+        self.reprocessed_samples = 0
+        self.reprocessing_seconds = 0.
+
+        # If we can't probe the preprocessor, everything is left to `finish`,
+        # which is then the same as the batch path
+        self._frame_hop = None
+        self._gain_exponent = None
+        try:
+            self._time_dim, self._frame_hop, self._before, self._after = probe_frames(
+                preprocessor, chunk_size * 4, chunk_size)
+            self._gain_exponent = probe_gain_exponent(preprocessor, chunk_size)
+        except (RuntimeError, ValueError) as e:
+            print("Error in StreamingRecognizer: Could not probe the preprocessor, "
+                  "falling back to recognizing the whole voice command at once - ", e)
+
+        self.reset()
+
+    def reset(self, ignored_samples=0):
+        # `ignored_samples` are zeroed out, the same way we do in the batch path
+        self.ignored_samples = ignored_samples
+        self.peak = 0.
+        self.num_restarts = 0
+        self.deferred = self._frame_hop is None
+        self.features = None
+        self.num_frames = 0
+        self._num_seen_samples = 0
+        self._start_over()
+
+    def _start_over(self):
+        self.hidden, self.c0 = self.model.get_initial_hidden(1)
+        self.outputs = []
+        self.num_recognized_frames = 0
+        self._recognized_peak = self.peak
+
+    def push(self, recording, final=False):
+        # Takes all the samples recorded so far and runs the model on the frames
+        # we haven't recognized yet
+        new_samples = recording[max(self._num_seen_samples, self.ignored_samples):]
+        self._num_seen_samples = recording.shape[0]
+        if new_samples.numel():
+            self.peak = max(self.peak, float(new_samples.abs().max()))
+
+        if self._frame_hop is None:
+            if final:
+                self.outputs = [self._recognize_from_scratch(recording)]
+            return
+
+        restart = self.num_recognized_frames and self.peak != self._recognized_peak
+        if not final and (self.deferred or restart and self.num_restarts >= self.max_restarts):
+            if not self.deferred:
+                self.deferred = True
+                if self.metrics:
+                    self.metrics.increment("streaming_deferred")
+
+            # Features that scale with the gain can still be computed ahead
+            if self._gain_exponent is not None:
+                self._compute_features(recording, final)
+            return
+
+        start_time = time.perf_counter()
+        if restart:
+            reprocessed_samples = self.num_recognized_frames * self._frame_hop
+            self._start_over()
+            if self._gain_exponent is None:
+                self.features = None
+                self.num_frames = 0
+
+        self._compute_features(recording, final)
+        self._recognize()
+
+        if restart:
+            seconds = time.perf_counter() - start_time
+            self.num_restarts += 1
+            self.restart_count += 1
+            self.reprocessed_samples += reprocessed_samples
+            self.reprocessing_seconds += seconds
+            if self.metrics:
+                self.metrics.increment("streaming_restarts")
+                self.metrics.observe("streaming_reprocessing", seconds)
+
+    def finish(self, recording):
+        # Returns the raw speech recognition output for the whole recording,
+        # concatenated across time
+        self.push(recording, final=True)
+        return torch.cat(self.outputs, dim=1)
+
+    def _segment(self, recording, start, end):
+        # The samples the preprocessor is given, with the ignored ones zeroed
+        # out, and normalized unless the features are scaled afterwards
+        segment = recording[start:end].clone()
+        segment[:max(self.ignored_samples - start, 0)] = 0
+        if self._gain_exponent is None:
+            normalize_peak(segment, peak=self.peak)
+        return segment
+
+    def _compute_features(self, recording, final):
+        # Appends the frames that are now complete, or all of the remaining ones
+        # once the recording is final
+        frame_hop, before, after = self._frame_hop, self._before, self._after
+        num_samples = recording.shape[0]
+        first = self.num_frames
+
+        if final:
+            end = num_samples
+        else:
+            # Frame `t` is complete once we have the samples up to `t * hop + after`
+            last = (num_samples - 1 - after) // frame_hop + 1
+            if last <= first:
+                return
+            end = (last - 1) * frame_hop + after + 1
+
+        # Start early enough for the first frame's receptive field, on a frame
+        # boundary, and give the preprocessor at least a few frames to work with
+        start = min(first * frame_hop - before, end - (before + after + frame_hop))
+        start = max(start // frame_hop * frame_hop, 0)
+
+        features = self.preprocessor(self._segment(recording, start, end).unsqueeze(0))
+        offset = start // frame_hop
+        if final:
+            last = offset + features.shape[self._time_dim]
+        if last <= first:
+            return
+
+        new_features = features.narrow(self._time_dim, first - offset, last - first)
+        self.features = new_features if self.features is None else\
+            torch.cat((self.features, new_features), self._time_dim)
+        self.num_frames = last
+
+    def _scale(self):
+        if self._gain_exponent is None:
+            return 1.
+        return peak_scale(self.peak) ** self._gain_exponent
+
+    def _recognize(self):
+        if self.num_frames <= self.num_recognized_frames:
+            return
+
+        features = self.features.narrow(self._time_dim, self.num_recognized_frames,
+            self.num_frames - self.num_recognized_frames)
+        output, self.hidden, self.c0 = self.model.recognize_chunk(
+            features * self._scale(), self.hidden, self.c0)
+        self.outputs.append(output)
+        self.num_recognized_frames = self.num_frames
+        self._recognized_peak = self.peak
+
+    def _recognize_from_scratch(self, recording):
+        # Only used if we couldn't probe the preprocessor, in which case the
+        # segment is normalized
+        output, _, _ = self.model.recognize_chunk(
+            self.preprocessor(self._segment(recording, 0, recording.shape[0]).unsqueeze(0)),
+            *self.model.get_initial_hidden(1))
+        return output
@@ -0,0 +1,60 @@
+import torch
+
+from audio_buffer import RingBuffer
+
+
+def test_latest_before_full():
+    buffer = RingBuffer(8)
+    buffer.extend(torch.arange(3.))
+
+    assert len(buffer) == 3
+    assert not buffer.is_full()
+    assert buffer.latest().tolist() == [0, 1, 2]
+
+
+def test_wrap_around_keeps_chronological_order():
+    buffer = RingBuffer(8)
+    expected = []
+    # Chunks that don't divide the capacity, so the writes wrap at every offset
+    for start in range(0, 30, 3):
+        chunk = torch.arange(start, start + 3.)
+        buffer.extend(chunk)
+        expected = (expected + chunk.tolist())[-8:]
+
+        assert buffer.latest().tolist() == expected
+        assert buffer.latest(5).tolist() == expected[-5:]
+
+    assert buffer.is_full()
+    assert buffer.total_samples == 30
+
+
+def test_extend_with_more_than_the_capacity():
+    buffer = RingBuffer(4)
+    buffer.extend(torch.arange(2.))
+    buffer.extend(torch.arange(10.))
+
+    assert buffer.latest().tolist() == [6, 7, 8, 9]
+    assert buffer.total_samples == 12
+
+
+def test_latest_is_a_view():
+    buffer = RingBuffer(4)
+    buffer.extend(torch.arange(6.))
+
+    latest = buffer.latest()
+    assert latest.is_contiguous()
+    assert latest.untyped_storage().data_ptr() ==\
+        buffer._storage.untyped_storage().data_ptr()
+
+
+def test_clear():
+    buffer = RingBuffer(4)
+    buffer.extend(torch.arange(6.))
+    buffer.clear()
+
+    assert len(buffer) == 0
+    assert buffer.total_samples == 0
+    assert buffer.latest().numel() == 0
+
+    buffer.extend(torch.tensor([7.]))
+    assert buffer.latest().tolist() == [7]
@@ -0,0 +1,51 @@
+import threading
+import torch
+
+from audio_output import Sound
+
+
+def test_mix_plays_the_chunks_in_order():
+    sound = Sound()
+    sound.feed(torch.tensor([[1.], [2.], [3.]]))
+    sound.feed(torch.tensor([[4.], [5.]]))
+    sound.close()
+
+    out = torch.zeros(4, 1)
+    sound.mix_into(out)
+    assert out.flatten().tolist() == [1, 2, 3, 4]
+    assert not sound.finished.is_set()
+
+    out = torch.zeros(4, 1)
+    sound.mix_into(out)
+    assert out.flatten().tolist() == [5, 0, 0, 0]
+    assert sound.finished.is_set()
+
+
+def test_stopped_sound_is_finished_and_silent():
+    sound = Sound()
+    sound.feed(torch.ones(10, 1))
+    sound.stop()
+    sound.feed(torch.ones(10, 1))
+
+    out = torch.zeros(4, 1)
+    sound.mix_into(out)
+    assert sound.wait(0)
+    assert out.abs().sum() == 0
+
+
+def test_stopping_while_mixing():
+    # The stop word stops a response on another thread while the audio thread
+    # is mixing it, which must never raise on the audio thread
+    for _ in range(500):
+        sound = Sound()
+        for _ in range(5):
+            sound.feed(torch.ones(7, 1))
+
+        stopper = threading.Thread(target=sound.stop)
+        stopper.start()
+        out = torch.zeros(16, 1)
+        for _ in range(3):
+            sound.mix_into(out)
+        stopper.join()
+
+        assert sound.finished.is_set()
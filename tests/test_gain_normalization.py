@@ -0,0 +1,72 @@
+import shutil
+import subprocess
+from pathlib import Path
+import pytest
+import torch
+
+from gain_normalization import normalize_peak, peak_scale, WindowPeakTracker
+
+
+DATA_DIR = Path(__file__).parent / "data"
+
+
+def read_samples(path):
+    return torch.frombuffer(bytearray(path.read_bytes()), dtype=torch.float32)
+
+
+def test_normalize_peak_scales_the_peak_to_one():
+    samples = (torch.rand(8000, generator=torch.Generator().manual_seed(0)) - .5) * .3
+
+    normalized = normalize_peak(samples.clone())
+
+    assert float(normalized.abs().max()) == pytest.approx(1.)
+    assert torch.allclose(normalized, samples / samples.abs().max())
+
+
+def test_normalize_peak_matches_sox_reference():
+    # The reference is the output of `sox gain -n` on the input, both stored as
+    # raw 32 bit floats at 8kHz, so this runs without sox installed
+    samples = read_samples(DATA_DIR / "sox_gain_n_input.f32")
+    expected = read_samples(DATA_DIR / "sox_gain_n_output.f32")
+
+    assert torch.allclose(normalize_peak(samples.clone()), expected, atol=1e-6)
+
+
+@pytest.mark.skipif(shutil.which("sox") is None, reason="sox is not installed")
+def test_normalize_peak_against_sox(tmp_path):
+    samples = (torch.rand(8000, generator=torch.Generator().manual_seed(1)) - .5) * .3
+    input_path, output_path = tmp_path / "in.f32", tmp_path / "out.f32"
+    input_path.write_bytes(samples.numpy().tobytes())
+
+    raw = ["-t", "raw", "-r", "8000", "-e", "floating-point", "-b", "32", "-c", "1"]
+    subprocess.run(["sox"] + raw + [str(input_path)] + raw + [str(output_path),
+        "gain", "-n"], check=True)
+    expected = torch.frombuffer(bytearray(output_path.read_bytes()), dtype=torch.float32)
+
+    assert torch.allclose(normalize_peak(samples.clone()), expected, atol=1e-4)
+
+
+def test_normalize_peak_out_and_peak():
+    samples = torch.tensor([.1, -.4, .2])
+    out = torch.empty(3)
+
+    normalize_peak(samples, out=out, peak=.8)
+
+    assert samples.tolist() == pytest.approx([.1, -.4, .2])
+    assert out.tolist() == pytest.approx([.125, -.5, .25])
+
+
+def test_silence_is_left_as_is():
+    assert peak_scale(0) == 1
+    assert normalize_peak(torch.zeros(4)).tolist() == [0, 0, 0, 0]
+
+
+def test_window_peak_tracker():
+    tracker = WindowPeakTracker(2)
+    tracker.update(torch.tensor([.1, -.9]))
+    tracker.update(torch.tensor([.2]))
+    assert tracker.peak == pytest.approx(.9)
+
+    # The loud chunk moves out of the window
+    tracker.update(torch.tensor([-.3]))
+    assert tracker.peak == pytest.approx(.3)
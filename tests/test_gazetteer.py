@@ -0,0 +1,100 @@
+import pytest
+
+from gazetteer import build, Gazetteer, normalize
+
+
+def geonames_row(id, name, ascii_name, alternate_names, population, timezone="Etc/UTC",
+        latlong=(1., 2.)):
+    # The columns of a GeoNames dump we use, with the rest left empty
+    columns = [""] * 19
+    columns[0], columns[1], columns[2], columns[3] = str(id), name, ascii_name,\
+        ",".join(alternate_names)
+    columns[4], columns[5] = str(latlong[0]), str(latlong[1])
+    columns[14], columns[17] = str(population), timezone
+    return "\t".join(columns)
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    rows = [
+        geonames_row(1, "London", "London", ["Londres", "Londra"], 8900000,
+            "Europe/London", (51.5, -.12)),
+        geonames_row(2, "London", "London", [], 380000, "America/Toronto"),
+        geonames_row(3, "Zürich", "Zurich", ["Zuerich"], 400000, "Europe/Zurich"),
+        geonames_row(4, "New York City", "New York City", ["New York", "NYC"], 8000000,
+            "America/New_York"),
+        geonames_row(5, "Rome", "Rome", ["Roma"], 2800000, "Europe/Rome"),
+        # Its alternate name is another city's name, but it's more populated
+        geonames_row(6, "Greater Springfield", "Greater Springfield", ["Springfield"],
+            900000),
+        geonames_row(7, "Springfield", "Springfield", [], 100000),
+        # Equally close to "berlij"
+        geonames_row(8, "Berlin", "Berlin", [], 3600000, "Europe/Berlin"),
+        geonames_row(9, "Berlik", "Berlik", [], 500),
+        "a line that isn't a place"]
+    geonames_path = tmp_path / "cities.txt"
+    geonames_path.write_text("\n".join(rows) + "\n", encoding="utf-8")
+
+    index_path = str(tmp_path / "gazetteer.idx")
+    build(str(geonames_path), index_path)
+    gazetteer = Gazetteer(index_path)
+    yield gazetteer
+    gazetteer.close()
+
+
+def test_normalize():
+    assert normalize("  São-Paulo!! ") == "sao paulo"
+
+
+def test_exact_match_prefers_the_most_populated(gazetteer):
+    place = gazetteer.lookup("London")
+    assert place.name == "London"
+    assert place.timezone == "Europe/London"
+    assert place.population == 8900000
+    assert place.latlong == pytest.approx((51.5, -.12))
+
+
+def test_ascii_and_alternate_names(gazetteer):
+    assert gazetteer.lookup("zurich").name == "Zürich"
+    assert gazetteer.lookup("Zürich").name == "Zürich"
+    assert gazetteer.lookup("londres").name == "London"
+    assert gazetteer.lookup("new york").name == "New York City"
+    assert gazetteer.lookup("nyc").name == "New York City"
+
+
+def test_primary_names_win_over_alternate_names(gazetteer):
+    assert gazetteer.lookup("springfield").population == 100000
+
+
+def test_fuzzy_matching_scales_with_the_length(gazetteer):
+    # Too short to forgive any edits
+    assert gazetteer.lookup("rom") is None
+    assert gazetteer.lookup("rme") is None
+    # Short names forgive one edit, longer ones two
+    assert gazetteer.lookup("rone").name == "Rome"
+    assert gazetteer.lookup("rmoe") is None
+    assert gazetteer.lookup("lundon").name == "London"
+    assert gazetteer.lookup("lundun").name == "London"
+    assert gazetteer.lookup("xondon") is None
+
+
+def test_ambiguous_fuzzy_matches(gazetteer):
+    assert gazetteer.lookup("berlij") is None
+    assert gazetteer.lookup("berlin").name == "Berlin"
+
+
+def test_no_match(gazetteer):
+    assert gazetteer.lookup("atlantis") is None
+    assert gazetteer.lookup("") is None
+    assert gazetteer.lookup("!!") is None
+
+
+@pytest.mark.parametrize("contents", [b"", b"KGZ", b"not a gazetteer index",
+    b"KGZ1" + b"\xff" * 12])
+def test_invalid_index(tmp_path, contents):
+    # get_gazetteer falls back to looking locations up online on a ValueError
+    path = tmp_path / "gazetteer.idx"
+    path.write_bytes(contents)
+
+    with pytest.raises(ValueError):
+        Gazetteer(str(path))
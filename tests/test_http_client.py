@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+from http_client import HttpClient
+
+
+@pytest.fixture
+def server():
+    # A local stand-in for the web apis, which answers with the path and how
+    # many requests it's had, unless it's been told to fail
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.request_count += 1
+            if self.server.failing:
+                self.send_error(500)
+                return
+
+            body = json.dumps({"path": self.path,
+                "count": self.server.request_count}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.request_count = 0
+    server.failing = False
+    server.url = "http://127.0.0.1:%i" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = HttpClient(cache_path=str(tmp_path / "cache.json"), max_cache_entries=2,
+        connect_timeout=1, read_timeout=1)
+    yield client
+    client.close()
+
+
+def test_fresh_responses_are_cached(server, client):
+    first = client.get_json(server.url + "/a", {"q": 1}, max_age=60)
+    second = client.get_json(server.url + "/a", {"q": 1}, max_age=60)
+
+    assert first == second == {"path": "/a?q=1", "count": 1}
+    assert server.request_count == 1
+    assert (client.hit_count, client.miss_count) == (1, 1)
+
+
+def test_stale_responses_are_refetched(server, client, monkeypatch):
+    client.get_json(server.url + "/a", max_age=60)
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert client.get_json(server.url + "/a", max_age=60)["count"] == 2
+
+
+def test_no_max_age_is_not_cached(server, client):
+    client.get_json(server.url + "/a")
+    client.get_json(server.url + "/a")
+
+    assert server.request_count == 2
+
+
+def test_least_recently_used_is_evicted(server, client):
+    for path in ["/a", "/b", "/a", "/c"]:
+        client.get_json(server.url + path, max_age=60)
+
+    # "/b" was the least recently used one when "/c" came in
+    count = server.request_count
+    client.get_json(server.url + "/a", max_age=60)
+    client.get_json(server.url + "/c", max_age=60)
+    assert server.request_count == count
+    client.get_json(server.url + "/b", max_age=60)
+    assert server.request_count == count + 1
+
+
+def test_stale_fallback_when_the_request_fails(server, client):
+    response = client.get_json(server.url + "/a", max_age=60)
+
+    server.failing = True
+    # A max age of 0 forces a request, which fails
+    assert client.get_json(server.url + "/a", max_age=0) == response
+    assert client.stale_count == 1
+
+    assert client.get_json(server.url + "/b", max_age=60) is None
+
+
+def test_cache_is_persisted(server, client, tmp_path):
+    response = client.get_json(server.url + "/a", max_age=60)
+
+    reloaded = HttpClient(cache_path=str(tmp_path / "cache.json"))
+    assert reloaded.get_json(server.url + "/a", max_age=60) == response
+    assert server.request_count == 1
@@ -0,0 +1,46 @@
+import copy
+import torch
+
+from inference_optimization import optimize_model, script_submodules
+
+
+class SpeechRecognitionModel(torch.nn.Module):
+    # A stand-in for the speech recognition model, with the same shape of
+    # inference method and an LSTM submodule
+    def __init__(self):
+        super(SpeechRecognitionModel, self).__init__()
+        self.lstm = torch.nn.LSTM(8, 6, batch_first=True)
+        self.linear = torch.nn.Linear(6, 4)
+
+    def get_initial_hidden(self, batch_size):
+        return torch.zeros(1, batch_size, 6), torch.zeros(1, batch_size, 6)
+
+    def recognize(self, features, hidden, c0):
+        output, _ = self.lstm(features.transpose(1, 2), (hidden, c0))
+        return torch.softmax(self.linear(output), 2)
+
+
+def test_scripted_lstm_model_can_recognize():
+    torch.manual_seed(0)
+    model = SpeechRecognitionModel().eval()
+    features = torch.rand(1, 8, 20)
+    with torch.no_grad():
+        expected = model.recognize(features, *model.get_initial_hidden(1))
+
+        scripted = script_submodules(copy.deepcopy(model))
+        output = scripted.recognize(features, *scripted.get_initial_hidden(1))
+
+    assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_scripted_and_quantized_lstm_model_can_recognize():
+    torch.manual_seed(0)
+    model = SpeechRecognitionModel().eval()
+    features = torch.rand(1, 8, 20)
+    with torch.no_grad():
+        expected = model.recognize(features, *model.get_initial_hidden(1))
+        optimized = optimize_model(model, quantize=True, script=True)
+        output = optimized.recognize(features, *optimized.get_initial_hidden(1))
+
+    assert output.shape == expected.shape
+    assert torch.allclose(output, expected, atol=.05)
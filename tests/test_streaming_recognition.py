@@ -0,0 +1,108 @@
+import pytest
+import torch
+import torchaudio
+
+from gain_normalization import normalize_peak
+from streaming_recognition import StreamingRecognizer
+
+
+class SpeechRecognitionModel(torch.nn.Module):
+    # A stand-in for the speech recognition model, with the same shape of
+    # inference methods
+    def __init__(self):
+        super(SpeechRecognitionModel, self).__init__()
+        self.lstm = torch.nn.LSTM(40, 28, batch_first=True)
+
+    def get_initial_hidden(self, batch_size):
+        return torch.zeros(1, batch_size, 28), torch.zeros(1, batch_size, 28)
+
+    def recognize(self, features, hidden, c0):
+        return self.recognize_chunk(features, hidden, c0)[0]
+
+    def recognize_chunk(self, features, hidden, c0):
+        output, (hidden, c0) = self.lstm(features.transpose(1, 2), (hidden, c0))
+        return torch.softmax(output, 2), hidden, c0
+
+
+def mel_spectrogram():
+    return torchaudio.transforms.MelSpectrogram(8000, n_fft=400, hop_length=160, n_mels=40)
+
+
+def log_mel_spectrogram():
+    # Doesn't scale with the gain, so the features have to be recomputed
+    mel = mel_spectrogram()
+    return lambda samples: (mel(samples) + 1e-6).log()
+
+
+def batch_recognize(model, preprocessor, recording, ignored_samples):
+    # What the listener does when it's not streaming
+    recording = recording.clone()
+    recording[:ignored_samples] = 0
+    return model.recognize(preprocessor(normalize_peak(recording).unsqueeze(0)),
+        *model.get_initial_hidden(1))
+
+
+def stream_recognize(recognizer, recording, ignored_samples, chunk_size=4000):
+    recognizer.reset(ignored_samples)
+    for end in range(chunk_size, recording.shape[0], chunk_size):
+        recognizer.push(recording[:end])
+    return recognizer.finish(recording)
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return SpeechRecognitionModel().eval()
+
+
+@pytest.mark.parametrize("make_preprocessor", [mel_spectrogram, log_mel_spectrogram])
+@pytest.mark.parametrize("ignored_samples", [0, 3000])
+@pytest.mark.parametrize("num_samples", [30000, 32000, 33333])
+def test_streaming_matches_batch(model, make_preprocessor, ignored_samples, num_samples):
+    generator = torch.Generator().manual_seed(num_samples)
+    recording = (torch.rand(num_samples, generator=generator) * 2 - 1) * .3
+    # The loudest bit comes half way through, so we have to start over once
+    recording[num_samples // 2] = .9
+    preprocessor = make_preprocessor()
+
+    with torch.no_grad():
+        expected = batch_recognize(model, preprocessor, recording, ignored_samples)
+        recognizer = StreamingRecognizer(model, preprocessor)
+        output = stream_recognize(recognizer, recording, ignored_samples)
+
+    assert recognizer.restart_count >= 1
+    assert output.shape == expected.shape
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_restarts_are_bounded(model):
+    # A command that keeps getting louder
+    generator = torch.Generator().manual_seed(0)
+    recording = (torch.rand(40000, generator=generator) * 2 - 1) *\
+        torch.linspace(.05, 1, 40000)
+    preprocessor = mel_spectrogram()
+
+    with torch.no_grad():
+        expected = batch_recognize(model, preprocessor, recording, 0)
+        recognizer = StreamingRecognizer(model, preprocessor, max_restarts=2)
+        output = stream_recognize(recognizer, recording, 0)
+
+    assert recognizer.deferred
+    # The two restarts while recording and the one in `finish`
+    assert recognizer.num_restarts == 3
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_falls_back_to_the_batch_path_if_probing_fails(model):
+    mel = mel_spectrogram()
+    # Frames that aren't evenly spaced, so the probing fails
+    preprocessor = lambda samples: mel(samples)[..., :-(samples.shape[1] // 7000) or None]
+    recording = torch.rand(20000, generator=torch.Generator().manual_seed(0)) - .5
+
+    with torch.no_grad():
+        expected = batch_recognize(model, preprocessor, recording, 1000)
+        recognizer = StreamingRecognizer(model, preprocessor)
+        output = stream_recognize(recognizer, recording, 1000)
+
+    assert recognizer.deferred
+    assert torch.allclose(output, expected)
@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+import pytest
+
+from timer_scheduler import TimerScheduler
+
+
+class Fired(list):
+    # The labels of the timers that have fired, in order
+    def __init__(self):
+        super(Fired, self).__init__()
+        self.event = threading.Event()
+
+    def on_fire(self, timer):
+        self.append(timer.label)
+        self.event.set()
+
+
+@pytest.fixture
+def fired():
+    return Fired()
+
+
+def wait_for(fired, count, timeout=5):
+    deadline = time.time() + timeout
+    while len(fired) < count and time.time() < deadline:
+        fired.event.wait(.05)
+        fired.event.clear()
+    return list(fired)
+
+
+def test_timers_fire_in_due_order(fired, tmp_path):
+    scheduler = TimerScheduler(fired.on_fire, str(tmp_path / "timers.json"))
+    scheduler.start()
+    try:
+        # Added out of order
+        scheduler.add(.3, "third")
+        scheduler.add(.1, "first")
+        scheduler.add(.2, "second")
+
+        assert [timer.label for timer in scheduler.list()] == ["first", "second", "third"]
+        assert wait_for(fired, 3) == ["first", "second", "third"]
+        assert scheduler.list() == []
+    finally:
+        scheduler.stop(1)
+
+
+def test_cancel(fired, tmp_path):
+    scheduler = TimerScheduler(fired.on_fire, str(tmp_path / "timers.json"))
+    scheduler.start()
+    try:
+        cancelled = scheduler.add(.1, "cancelled")
+        scheduler.add(.2, "kept")
+
+        assert scheduler.cancel(cancelled)
+        assert not scheduler.cancel(cancelled)
+        assert wait_for(fired, 1) == ["kept"]
+        # Give the cancelled one a chance to fire, if it was going to
+        time.sleep(.1)
+        assert fired == ["kept"]
+    finally:
+        scheduler.stop(1)
+
+
+def test_cancel_all(fired, tmp_path):
+    scheduler = TimerScheduler(fired.on_fire, str(tmp_path / "timers.json"))
+    scheduler.add(60, "a")
+    scheduler.add(120, "b")
+
+    assert scheduler.cancel_all() == 2
+    assert scheduler.list() == []
+
+
+def test_timers_are_persisted(fired, tmp_path):
+    path = str(tmp_path / "timers.json")
+    scheduler = TimerScheduler(fired.on_fire, path)
+    first = scheduler.add(60, "a")
+    scheduler.add(120, "b")
+
+    reloaded = TimerScheduler(fired.on_fire, path)
+    assert [timer.label for timer in reloaded.list()] == ["a", "b"]
+    # New ids don't clash with the persisted ones
+    assert reloaded.add(30) > first + 1
+
+
+def test_long_overdue_timers_are_dropped(fired, tmp_path):
+    path = str(tmp_path / "timers.json")
+    now = time.time()
+    with open(path, "w") as f:
+        json.dump([[1, now - 3600, "missed"], [2, now - 5, "late"], [3, now + 60, "pending"]], f)
+
+    scheduler = TimerScheduler(fired.on_fire, path, missed_grace_period=60)
+    assert [timer.label for timer in scheduler.missed_timers] == ["missed"]
+    assert [timer.label for timer in scheduler.pop_missed_timers()] == ["missed"]
+    assert scheduler.pop_missed_timers() == []
+
+    scheduler.start()
+    try:
+        assert wait_for(fired, 1) == ["late"]
+        assert [timer.label for timer in scheduler.list()] == ["pending"]
+    finally:
+        scheduler.stop(1)
@@ -0,0 +1,120 @@
+import struct
+import threading
+import pytest
+
+from voice_synthesizer import WavStreamParser, play_wavs
+
+
+def make_wav(frames, channels=1, sample_width=2, frame_rate=22050, extra_chunk=b"",
+        data_size=None):
+    fmt = struct.pack("<HHIIHH", 1, channels, frame_rate,
+        frame_rate * channels * sample_width, channels * sample_width, sample_width * 8)
+    # Streaming servers don't know the size of the data up front
+    data_size = len(frames) if data_size is None else data_size
+    body = b"WAVE" + b"fmt " + struct.pack("<I", len(fmt)) + fmt + extra_chunk +\
+        b"data" + struct.pack("<I", data_size) + frames
+    return b"RIFF" + struct.pack("<I", 4 + len(body)) + body
+
+
+def feed_in_chunks(parser, data, chunk_size):
+    return b"".join(parser.feed(data[i:i + chunk_size])
+        for i in range(0, len(data), chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 44, 45, 1000])
+def test_chunk_boundaries(chunk_size):
+    frames = bytes(range(256)) * 4
+    parser = WavStreamParser()
+
+    assert feed_in_chunks(parser, make_wav(frames), chunk_size) == frames
+    assert (parser.sample_width, parser.channels, parser.frame_rate) == (2, 1, 22050)
+
+
+def test_only_whole_frames_are_returned():
+    parser = WavStreamParser()
+    header = make_wav(b"", channels=2)
+
+    assert parser.feed(header) == b""
+    # A stereo 16 bit frame is 4 bytes
+    assert parser.feed(b"abcdef") == b"abcd"
+    assert parser.feed(b"gh") == b"efgh"
+
+
+def test_placeholder_data_size_is_ignored():
+    frames = b"\x01\x02" * 100
+    parser = WavStreamParser()
+
+    assert feed_in_chunks(parser, make_wav(frames, data_size=0xffffffff), 16) == frames
+
+
+def test_chunks_before_data_are_skipped():
+    frames = b"\x01\x02" * 10
+    # An odd sized chunk, which is padded to an even size
+    extra_chunk = b"LIST" + struct.pack("<I", 5) + b"abcde\x00"
+    parser = WavStreamParser()
+
+    assert feed_in_chunks(parser, make_wav(frames, extra_chunk=extra_chunk), 5) == frames
+
+
+def test_not_a_wav_stream():
+    with pytest.raises(ValueError):
+        WavStreamParser().feed(b"ID3\x03" + b"\x00" * 20)
+
+
+class FakeSound(object):
+    def __init__(self):
+        self.fed = []
+        self.closed = False
+
+    def feed(self, samples):
+        self.fed.append(samples)
+
+    def close(self):
+        self.closed = True
+
+    def stop(self):
+        pass
+
+    def wait(self, timeout=None):
+        return self.closed
+
+
+class FakeAudioOutput(object):
+    def __init__(self):
+        self.sounds = []
+
+    def open_sound(self):
+        self.sounds.append(FakeSound())
+        return self.sounds[-1]
+
+    def to_samples(self, frames, sample_width, channels, frame_rate):
+        return frames
+
+
+def test_wavs_are_played_as_one_sound():
+    audio_output = FakeAudioOutput()
+    wavs = [make_wav(b"\x01\x00" * 4), make_wav(b"\x02\x00" * 3, frame_rate=8000)]
+
+    time_to_first_audio, _ = play_wavs(([wav[:30], wav[30:]] for wav in wavs),
+        audio_output=audio_output)
+
+    assert time_to_first_audio is not None
+    assert len(audio_output.sounds) == 1
+    sound = audio_output.sounds[0]
+    assert sound.closed
+    assert b"".join(sound.fed) == b"\x01\x00" * 4 + b"\x02\x00" * 3
+
+
+def test_cancelled_wavs_stop_being_fed():
+    audio_output = FakeAudioOutput()
+    cancel_event = threading.Event()
+
+    def wavs():
+        yield [make_wav(b"\x01\x00" * 4)]
+        cancel_event.set()
+        yield [make_wav(b"\x02\x00" * 3)]
+
+    play_wavs(wavs(), cancel_event, audio_output=audio_output)
+
+    assert b"".join(audio_output.sounds[0].fed) == b"\x01\x00" * 4
+    assert audio_output.sounds[0].closed
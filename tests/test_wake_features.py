@@ -0,0 +1,90 @@
+import pytest
+import torch
+import torchaudio
+
+from audio_buffer import RingBuffer
+from gain_normalization import normalize_peak, WindowPeakTracker
+from wake_features import WakeFeatureCache
+
+# The same sizes the listener uses
+CHUNK_SIZE = 4000
+WINDOW_SIZE = 12000
+PADDED_WINDOW_SIZE = 24000
+
+
+def mel_spectrogram():
+    return torchaudio.transforms.MelSpectrogram(8000, n_fft=400, hop_length=160, n_mels=40)
+
+
+def log_mel_spectrogram():
+    mel = mel_spectrogram()
+    return lambda samples: (mel(samples) + 1e-6).log()
+
+
+def full_features(preprocessor, window):
+    # What the listener used to compute for every window
+    padded = torch.cat((normalize_peak(window.clone()),
+        torch.zeros(PADDED_WINDOW_SIZE - WINDOW_SIZE)))
+    return preprocessor(padded.unsqueeze(0))
+
+
+def check_against_full(preprocessor, cache):
+    generator = torch.Generator().manual_seed(0)
+    buffer = RingBuffer(WINDOW_SIZE)
+    peak_tracker = WindowPeakTracker(WINDOW_SIZE // CHUNK_SIZE)
+
+    num_checked = 0
+    for i in range(12):
+        # Get louder and quieter, so the peak of the window keeps changing
+        chunk = (torch.rand(CHUNK_SIZE, generator=generator) * 2 - 1) * (.1 + .8 * (i % 3 == 1))
+        buffer.extend(chunk)
+        peak_tracker.update(chunk)
+
+        # Skip some windows, like the energy gate does with background noise
+        if not buffer.is_full() or i in (4, 7, 8):
+            continue
+
+        window = buffer.latest()
+        expected = full_features(preprocessor, window)
+        features = cache(window, peak_tracker.peak, buffer.total_samples)
+
+        assert features.shape == expected.shape
+        assert torch.allclose(features, expected, rtol=1e-4,
+            atol=1e-4 * float(expected.abs().max()))
+        num_checked += 1
+
+    assert num_checked == 7
+
+
+@pytest.mark.parametrize("make_preprocessor, mode", [
+    (mel_spectrogram, "incremental"),
+    (log_mel_spectrogram, "truncated")])
+def test_matches_the_full_features(make_preprocessor, mode):
+    preprocessor = make_preprocessor()
+    cache = WakeFeatureCache(preprocessor, WINDOW_SIZE, PADDED_WINDOW_SIZE, CHUNK_SIZE)
+
+    assert cache.mode == mode
+    check_against_full(preprocessor, cache)
+
+
+def test_falls_back_to_full_if_probing_fails():
+    mel = mel_spectrogram()
+    # Averaging over time hides the time dimension from the probing
+    preprocessor = lambda samples: mel(samples).mean(-1, keepdim=True)
+    cache = WakeFeatureCache(preprocessor, WINDOW_SIZE, PADDED_WINDOW_SIZE, CHUNK_SIZE)
+
+    assert cache.mode == "full"
+    check_against_full(preprocessor, cache)
+
+
+def test_falls_back_to_full_if_the_faster_modes_dont_match():
+    mel = mel_spectrogram()
+    # Probes fine, but depends on the length of the input, so neither the
+    # incremental nor the truncated features, which are computed on shorter
+    # inputs, can match
+    preprocessor = lambda samples: mel(samples) * samples.shape[1]
+    cache = WakeFeatureCache(preprocessor, WINDOW_SIZE, PADDED_WINDOW_SIZE, CHUNK_SIZE)
+
+    assert cache._gain_exponent == 2
+    assert cache.mode == "full"
+    check_against_full(preprocessor, cache)
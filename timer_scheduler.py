@@ -0,0 +1,186 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+
+# Runs any number of timers off a single thread, rather than a sleeping thread
+# per timer.
+#
+# The pending timers are kept in a heap ordered by when they're due, and the
+# scheduler thread waits on a condition until the earliest one, or until it's
+# woken up because a timer has been added or cancelled. Cancelled timers are
+# only removed from the `timers` dict and are skipped once they reach the top
+# of the heap.
+#
+# The timers are persisted to a json file, so they survive restarting Kronos.
+# Ones that were due while we weren't running fire straight away, unless they
+# were due more than `missed_grace_period` seconds ago, as an alarm going off
+# hours late is more confusing than useful. Those are dropped and kept in
+# `missed_timers`, until `pop_missed_timers` hands them out to be mentioned
+# instead.
+
+DEFAULT_PERSIST_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "kronos", "timers.json")
+
+
+class Timer(object):
+    __slots__ = ("id", "due_time", "label")
+
+    def __init__(self, id, due_time, label=None):
+        self.id = id
+        self.due_time = due_time
+        self.label = label
+
+    def remaining(self):
+        return max(self.due_time - time.time(), 0)
+
+
+class TimerScheduler(object):
+    # `on_fire` is called with the Timer on the scheduler thread, so it should
+    # hand anything slow off, rather than hold up the timers that come after
+    def __init__(self, on_fire, persist_path=DEFAULT_PERSIST_PATH,
+            missed_grace_period=60):
+        self.on_fire = on_fire
+        self.persist_path = persist_path
+        self.missed_timers = []
+
+        self.timers = {}
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+        if persist_path:
+            try:
+                with open(persist_path) as f:
+                    persisted = json.load(f)
+            except (IOError, ValueError):
+                persisted = []
+
+            now = time.time()
+            for id, due_time, label in persisted:
+                if now - due_time > missed_grace_period:
+                    self.missed_timers.append(Timer(id, due_time, label))
+                else:
+                    self._push(Timer(id, due_time, label))
+            self._ids = itertools.count(max(self.timers.keys(), default=0) + 1)
+
+            if self.missed_timers:
+                print("Warning in TimerScheduler: Dropped %i timers that went off "
+                      "while we weren't running" % len(self.missed_timers))
+                self._save()
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def add(self, delay_in_seconds, label=None):
+        # Returns the id of the new timer, which can be used to cancel it
+        with self._condition:
+            timer = Timer(next(self._ids), time.time() + delay_in_seconds, label)
+            self._push(timer)
+            self._save()
+            self._condition.notify()
+        return timer.id
+
+    def cancel(self, id):
+        # Returns whether there was a pending timer with that id
+        with self._condition:
+            if self.timers.pop(id, None) is None:
+                return False
+            self._save()
+            self._condition.notify()
+        return True
+
+    def cancel_all(self):
+        # Returns the number of cancelled timers
+        with self._condition:
+            count = len(self.timers)
+            self.timers.clear()
+            self._heap = []
+            self._save()
+            self._condition.notify()
+        return count
+
+    def list(self):
+        # The pending timers, soonest first
+        with self._condition:
+            return sorted(self.timers.values(), key=lambda timer: timer.due_time)
+
+    def pop_missed_timers(self):
+        # The timers that were dropped when we started, which are only handed
+        # out once
+        with self._condition:
+            missed_timers, self.missed_timers = self.missed_timers, []
+        return missed_timers
+
+    def _push(self, timer):
+        self.timers[timer.id] = timer
+        heapq.heappush(self._heap, (timer.due_time, timer.id))
+
+    def _save(self):
+        # Expects the condition to be held
+        if not self.persist_path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+            tmp_path = "%s.%i.tmp" % (self.persist_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump([(timer.id, timer.due_time, timer.label)
+                    for timer in self.timers.values()], f)
+            os.replace(tmp_path, self.persist_path)
+        except (IOError, OSError) as e:
+            print("Error in TimerScheduler._save: Could not write %s - " % self.persist_path, e)
+
+    def _pop_due(self):
+        # Expects the condition to be held. Returns the timers that are due and
+        # how long until the next one is, or None if there are none left.
+        due = []
+        now = time.time()
+        while self._heap:
+            due_time, id = self._heap[0]
+            if id not in self.timers or self.timers[id].due_time != due_time:
+                # Cancelled
+                heapq.heappop(self._heap)
+                continue
+            if due_time > now:
+                return due, due_time - now
+            heapq.heappop(self._heap)
+            due.append(self.timers.pop(id))
+        return due, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+
+                due, wait_time = self._pop_due()
+                if due:
+                    self._save()
+                else:
+                    self._condition.wait(wait_time)
+                    continue
+
+            for timer in due:
+                try:
+                    self.on_fire(timer)
+                except Exception as e:
+                    print("Error in TimerScheduler: Firing timer %i failed - " % timer.id, e)
@@ -0,0 +1,137 @@
+import collections
+import time
+
+
+class NoiseFloorEstimator(object):
+    # Keeps a running estimate of the background noise energy. It follows
+    # the energy down quickly, but only creeps up slowly, so short bursts of
+    # speech don't drag the noise floor up with them.
+    def __init__(self, fall_rate=.5, rise_rate=.01, initial_floor=None):
+        self.fall_rate = fall_rate
+        self.rise_rate = rise_rate
+        self.floor = initial_floor
+
+    def update(self, energy):
+        energy = float(energy)
+        if self.floor is None:
+            self.floor = energy
+        elif energy < self.floor:
+            self.floor += (energy - self.floor) * self.fall_rate
+        else:
+            self.floor += (energy - self.floor) * self.rise_rate
+        return self.floor
+
+
+def frame_energies(samples, frame_size):
+    # RMS energy of each full frame in the samples
+    num_frames = samples.shape[0] // frame_size
+    frames = samples[:num_frames * frame_size].reshape(num_frames, frame_size)
+    return frames.pow(2).mean(1).sqrt()
+
+
+class VoiceActivityDetector(object):
+    # A small energy based voice activity detector, used to tell when a
+    # voice command has finished, so we don't have to record for a fixed
+    # amount of time.
+    #
+    # The samples are split into 20ms frames and each frame that is louder than
+    # both `speech_to_noise_ratio` times the noise floor and `min_speech_energy`
+    # counts as speech. Once we've heard speech, we wait for `hangover` seconds of
+    # silence before we consider the command finished, and regardless of that we
+    # never record for longer than `max_duration` seconds.
+    def __init__(self, sample_rate=8000, frame_duration=.02, hangover=.5,
+            max_duration=4, speech_to_noise_ratio=3., min_speech_energy=.005):
+        self.sample_rate = sample_rate
+        self.frame_size = int(sample_rate * frame_duration)
+        self.hangover_samples = int(sample_rate * hangover)
+        self.max_samples = int(sample_rate * max_duration)
+        self.speech_to_noise_ratio = speech_to_noise_ratio
+        self.min_speech_energy = min_speech_energy
+
+        self.noise_floor = NoiseFloorEstimator()
+        self.reset()
+
+    def reset(self, ignored_samples=0):
+        # `ignored_samples` lets us skip the beginning of the recording, which
+        # usually contains the end of the wake word and the wake notification
+        self.ignored_samples = ignored_samples
+        self.num_samples = 0
+        self.speech_detected = False
+        self.trailing_silence_samples = 0
+        self.end_of_speech_time = None
+
+    def update_noise_floor(self, samples):
+        # Meant to be called with audio we know is not part of a command, so
+        # we can keep track of the background noise while idle
+        for energy in frame_energies(samples, self.frame_size).tolist():
+            self.noise_floor.update(energy)
+
+    def is_speech(self, energy):
+        floor = self.noise_floor.floor or 0
+        return energy > max(floor * self.speech_to_noise_ratio, self.min_speech_energy)
+
+    def process(self, samples):
+        # Returns True once the command is considered finished
+        start = max(self.ignored_samples - self.num_samples, 0)
+        self.num_samples += samples.shape[0]
+
+        for energy in frame_energies(samples[start:], self.frame_size).tolist():
+            if self.is_speech(energy):
+                self.speech_detected = True
+                self.trailing_silence_samples = 0
+            else:
+                self.trailing_silence_samples += self.frame_size
+                if not self.speech_detected:
+                    self.noise_floor.update(energy)
+
+        finished = self.num_samples >= self.max_samples or (self.speech_detected and
+            self.trailing_silence_samples >= self.hangover_samples)
+
+        if finished:
+            # Estimate when the speaking actually stopped, so we can measure the
+            # latency between that and us responding
+            self.end_of_speech_time = time.time() -\
+                self.trailing_silence_samples / self.sample_rate
+
+        return finished
+
+
+class EnergyGate(object):
+    # A cheap check in front of the wake word detection, so we don't bother
+    # running the model on windows that are nothing but background noise.
+    #
+    # We keep the energy of the loudest frame of each of the last `num_chunks`
+    # chunks and let a window through only if its loudest frame is louder than
+    # both `open_ratio` times the noise floor and `min_energy`. This looks at the
+    # raw audio, as the gain normalization boosts silence all the way up.
+    def __init__(self, num_chunks, sample_rate=8000, frame_duration=.02,
+            open_ratio=2., min_energy=1e-4):
+        self.frame_size = int(sample_rate * frame_duration)
+        self.open_ratio = open_ratio
+        self.min_energy = min_energy
+
+        self.noise_floor = NoiseFloorEstimator()
+        self.chunk_energies = collections.deque(maxlen=num_chunks)
+
+        # Counters of how many windows we've skipped and how many we've let through
+        self.gated_count = 0
+        self.evaluated_count = 0
+
+    def clear(self):
+        self.chunk_energies.clear()
+
+    def update(self, chunk):
+        energies = frame_energies(chunk, self.frame_size)
+        self.chunk_energies.append(float(energies.max()) if energies.numel() else 0.)
+
+        for energy in energies.tolist():
+            self.noise_floor.update(energy)
+
+    def is_open(self):
+        threshold = max((self.noise_floor.floor or 0) * self.open_ratio, self.min_energy)
+        if self.chunk_energies and max(self.chunk_energies) > threshold:
+            self.evaluated_count += 1
+            return True
+
+        self.gated_count += 1
+        return False
@@ -1,46 +1,231 @@
-from ibm_watson import TextToSpeechV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from dotenv import load_dotenv
+import concurrent.futures
 import os
-import tempfile
-import pyaudio
-import wave
+import struct
+import threading
+import time
 
-load_dotenv()
+from audio_output import get_audio_output
 
-WATSON_API_KEY = os.getenv("WATSON_API_KEY")
-WATSON_URL = os.getenv("WATSON_URL")
 
-authenticator = IAMAuthenticator(WATSON_API_KEY)
-text_to_speech = TextToSpeechV1(
-    authenticator=authenticator
-)
+# The Watson client is only created the first time we synthesize something,
+# so importing this module doesn't slow down starting up
+_text_to_speech = None
 
-text_to_speech.set_service_url(WATSON_URL)
+# Only one response is spoken at a time through each AudioOutput
+_speaking_locks = {}
 
-p = pyaudio.PyAudio()
+# Synthesized speech is only cached if we're given a SpeechCache
+_speech_cache = None
 
-def synthesize(text):
-    tmp_file = tempfile.mkstemp(".wav")[1]
+VOICE = "en-GB_JamesV3Voice"
+ACCEPT = "audio/wav"
+RESPONSE_CHUNK_SIZE = 2048
 
-    with open(tmp_file, "wb") as af:
-        af.write(text_to_speech.synthesize(
-            text, voice="en-GB_JamesV3Voice",
-            accept="audio/wav").get_result().content)
+def get_text_to_speech():
+    global _text_to_speech
+    if _text_to_speech is None:
+        from ibm_watson import TextToSpeechV1
+        from ibm_cloud_sdk_core.authenticators import IAMAuthenticator,\
+            NoAuthAuthenticator
+        from dotenv import load_dotenv
 
-    wf = wave.open(tmp_file)
-    stream = p.open(
-        format=pyaudio.get_format_from_width(wf.getsampwidth()),
-        channels=wf.getnchannels(),
-        rate=wf.getframerate(),
-        output=True)
+        load_dotenv()
 
-    data = wf.readframes(1024)
-    while data:
-        stream.write(data)
-        data = wf.readframes(1024)
+        # Without an api key we assume WATSON_URL points to a local stand-in
+        # server, e.g. for testing
+        api_key = os.getenv("WATSON_API_KEY")
+        authenticator = IAMAuthenticator(api_key) if api_key else NoAuthAuthenticator()
+        _text_to_speech = TextToSpeechV1(
+            authenticator=authenticator
+        )
 
-    stream.close()
-    wf.close()
+        _text_to_speech.set_service_url(os.getenv("WATSON_URL"))
+    return _text_to_speech
 
-    os.remove(tmp_file)
+def set_speech_cache(speech_cache):
+    global _speech_cache
+    _speech_cache = speech_cache
+
+class WavStreamParser(object):
+    # Parses a wav file as it comes in, chunk by chunk, and hands out whole
+    # frames of PCM data as soon as the header has been read.
+    #
+    # When streaming, the size of the data chunk isn't known up front, so
+    # servers tend to put in a placeholder, which is why we ignore it and treat
+    # everything after the start of the data chunk as audio.
+    def __init__(self):
+        self.sample_width = None
+        self.channels = None
+        self.frame_rate = None
+        self._buffer = b""
+        self._in_data = False
+
+    @property
+    def frame_size(self):
+        return self.sample_width * self.channels
+
+    def feed(self, data):
+        # Returns the whole frames that are now available, which is empty until
+        # we've got through the header
+        self._buffer += data
+
+        if not self._in_data:
+            self._parse_header()
+            if not self._in_data:
+                return b""
+
+        num_bytes = len(self._buffer) - len(self._buffer) % self.frame_size
+        frames, self._buffer = self._buffer[:num_bytes], self._buffer[num_bytes:]
+        return frames
+
+    def _parse_header(self):
+        if len(self._buffer) < 12:
+            return
+        if self._buffer[:4] != b"RIFF" or self._buffer[8:12] != b"WAVE":
+            raise ValueError("Not a wav stream")
+
+        position = 12
+        while len(self._buffer) >= position + 8:
+            chunk_id = self._buffer[position:position + 4]
+            chunk_size, = struct.unpack("<I", self._buffer[position + 4:position + 8])
+            position += 8
+
+            if chunk_id == b"data":
+                if self.sample_width is None:
+                    raise ValueError("Wav stream has no fmt chunk before its data")
+                self._buffer = self._buffer[position:]
+                self._in_data = True
+                return
+
+            # Chunks are padded to an even size
+            if len(self._buffer) < position + chunk_size + chunk_size % 2:
+                return
+
+            if chunk_id == b"fmt ":
+                audio_format, self.channels, self.frame_rate, _, _, bits_per_sample =\
+                    struct.unpack("<HHIIHH", self._buffer[position:position + 16])
+                if audio_format != 1:
+                    raise ValueError("Wav stream is not PCM")
+                self.sample_width = bits_per_sample // 8
+
+            position += chunk_size + chunk_size % 2
+
+def synthesize_chunks(text):
+    # Yields the wav response of the text to speech service as it arrives
+    response = get_text_to_speech().synthesize(
+        text, voice=VOICE, accept=ACCEPT, stream=True).get_result()
+    try:
+        for chunk in response.iter_content(RESPONSE_CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.close()
+
+def cached_synthesize_chunks(text):
+    # Like `synthesize_chunks`, but comes from the speech cache if we can,
+    # and otherwise caches the response once it has all arrived
+    if _speech_cache is None:
+        yield from synthesize_chunks(text)
+        return
+
+    audio = _speech_cache.get(text, VOICE, ACCEPT)
+    if audio is not None:
+        yield audio
+        return
+
+    received = []
+    for chunk in synthesize_chunks(text):
+        received.append(chunk)
+        yield chunk
+
+    # We don't get here if the playback was cancelled half way through, so we
+    # only ever cache whole responses
+    _speech_cache.put(text, VOICE, ACCEPT, b"".join(received))
+
+def play_wav_chunks(chunks, cancel_event=None, start_time=None, audio_output=None):
+    # Plays a wav file, given as an iterable of byte chunks, as soon as its
+    # frames come in, through the given AudioOutput, or the default one.
+    # Returns the time to first audio (from `start_time`) and the duration of
+    # the playback in seconds.
+    return play_wavs([chunks], cancel_event, start_time, audio_output)
+
+def play_wavs(wavs, cancel_event=None, start_time=None, audio_output=None):
+    # Like `play_wav_chunks`, but plays several wav files, each given as an
+    # iterable of byte chunks, one after the other as a single sound, so
+    # there's no gap between them
+    start_time = start_time or time.time()
+    audio_output = audio_output or get_audio_output()
+    time_to_first_audio = None
+    playback_start = None
+
+    with _speaking_locks.setdefault(audio_output, threading.Lock()):
+        sound = audio_output.open_sound()
+        try:
+            for chunks in wavs:
+                # Each file has its own header
+                parser = WavStreamParser()
+                for chunk in chunks:
+                    if cancel_event and cancel_event.is_set():
+                        break
+
+                    frames = parser.feed(chunk)
+                    if not frames:
+                        continue
+
+                    if time_to_first_audio is None:
+                        playback_start = time.time()
+                        time_to_first_audio = playback_start - start_time
+                    sound.feed(audio_output.to_samples(frames, parser.sample_width,
+                        parser.channels, parser.frame_rate))
+
+                if cancel_event and cancel_event.is_set():
+                    break
+        finally:
+            # Even if the response fails half way through, the sound has to be
+            # closed, otherwise the engine keeps mixing it in forever
+            sound.close()
+
+        # The engine plays the sound on its own thread, so we wait for it to
+        # finish, or for us to be cancelled
+        while not sound.wait(.05):
+            if cancel_event and cancel_event.is_set():
+                sound.stop()
+
+    playback_duration = time.time() - playback_start if playback_start else 0
+    return time_to_first_audio, playback_duration
+
+def synthesize(text, cancel_event=None, audio_output=None):
+    # If the `cancel_event` is set while we're speaking, we stop.
+    # The speech is played through `audio_output`, or the default one.
+    # Returns the timings of the time to first audio and the playback.
+    start_time = time.time()
+    segments = _speech_cache.segments(text) if _speech_cache else [text]
+
+    if len(segments) == 1:
+        time_to_first_audio, playback_duration = play_wav_chunks(
+            cached_synthesize_chunks(text), cancel_event, start_time, audio_output)
+    else:
+        # Fetch all the segments at the same time, so the ones that aren't
+        # cached are ready by the time we've played the ones before them, and
+        # play them in order as one sound, so there are no gaps between them
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(lambda segment: b"".join(
+                    cached_synthesize_chunks(segment)), segment)
+                for segment in segments]
+
+            time_to_first_audio, playback_duration = play_wavs(
+                ([future.result()] for future in futures),
+                cancel_event, start_time, audio_output)
+
+    if time_to_first_audio is None:
+        print("Error in voice_synthesizer.synthesize: No audio was received for", text)
+        return {}
+
+    print("Time to first audio: %.2fs, playback: %.2fs" % (
+        time_to_first_audio, playback_duration))
+    if _speech_cache:
+        stats = _speech_cache.stats()
+        print("Speech cache hit ratio: %.2f, bytes saved: %i" % (
+            stats["hit_ratio"], stats["bytes_saved"]))
+
+    return {"time_to_first_audio": time_to_first_audio,
+            "playback_duration": playback_duration}
@@ -0,0 +1,254 @@
+import torch
+
+from gain_normalization import normalize_peak, peak_scale
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+def probe_frames(preprocessor, num_samples, hop_size):
+    # Probes a preprocessor we don't know the internals of, on `num_samples`
+    # long inputs, and returns
+    # - along which dimension of its output is time
+    # - how many samples apart its frames are (the frame hop), which has to
+    #   divide `hop_size`
+    # - which samples each frame depends on, with frame `t` depending on the
+    #   samples between `t * frame_hop - before` and `t * frame_hop + after`
+    # Raises ValueError if the preprocessor doesn't look like that.
+    #
+    # The time dimension is the one that changes with the length of the input
+    zeros = preprocessor(torch.zeros(1, num_samples))
+    shorter = preprocessor(torch.zeros(1, num_samples - hop_size))
+    differing_dims = [i for i, (a, b) in enumerate(zip(zeros.shape, shorter.shape))
+        if a != b]
+    if zeros.dim() != shorter.dim() or len(differing_dims) != 1:
+        raise ValueError("Could not find the time dimension")
+
+    time_dim = differing_dims[0]
+    num_frames = zeros.shape[time_dim]
+    frames_per_hop = num_frames - shorter.shape[time_dim]
+    if frames_per_hop <= 0 or hop_size % frames_per_hop:
+        raise ValueError("The hop size is not a multiple of the frame hop")
+    frame_hop = hop_size // frames_per_hop
+
+    # Find the receptive field, by placing impulses in the middle of the
+    # input and checking which frames change
+    before, after = 0, 0
+    middle = (num_samples // 2) // frame_hop * frame_hop
+    for offset in range(frame_hop):
+        impulse = torch.zeros(1, num_samples)
+        impulse[0, middle + offset] = 1
+        changed = (preprocessor(impulse) != zeros).transpose(0, time_dim)
+        changed = changed.reshape(num_frames, -1).any(1).nonzero().flatten()
+        if not changed.numel():
+            continue
+
+        sample = middle + offset
+        before = max(before, int(changed[-1]) * frame_hop - sample)
+        after = max(after, sample - int(changed[0]) * frame_hop)
+
+    return time_dim, frame_hop, before, after
+
+
+def probe_gain_exponent(preprocessor, num_samples):
+    # Returns `k` if scaling the input by `g` scales the features by `g ** k`,
+    # or None if it doesn't for either k = 1 or 2
+    x = torch.rand(1, num_samples) * 2 - 1
+    x_features, x2_features = preprocessor(x), preprocessor(x * 2)
+    gain_exponent = None
+    for exponent in (1, 2):
+        if torch.allclose(x2_features, x_features * 2 ** exponent,
+                rtol=1e-4, atol=1e-6 * float(x2_features.abs().max())):
+            gain_exponent = exponent
+    return gain_exponent
+
+
+class WakeFeatureCache(object):
+    # Computes the wake word model inputs for a sliding window of audio, that is
+    # gain normalized and padded with zeros, without recomputing the features
+    # of the whole padded window every time it moves.
+    #
+    # We don't know the internals of the preprocessor, so on construction we
+    # probe it to find out
+    # - along which dimension of its output is time
+    # - how many samples apart its frames are (the hop)
+    # - which samples each frame depends on (its receptive field)
+    # - whether scaling the input by `g` scales the features by `g ** k`
+    # and based on that use one of these modes:
+    # - "incremental" - the features are homogeneous, so we compute them on the
+    #   raw (not normalized) audio, and only for the frames that depend on new
+    #   samples, reuse the cached frames for the rest and then scale them all by
+    #   the gain. Only the few frames at the edges of the window are recomputed
+    #   every time.
+    # - "truncated" - we only compute the frames that depend on the audio and
+    #   reuse a precomputed block of features for the frames that only cover the
+    #   zero padding
+    # - "full" - we compute the features of the whole padded window every time,
+    #   which is what we used to do
+    #
+    # Each mode is checked against the "full" one on random audio before it's
+    # used, so if the preprocessor doesn't behave as expected, we fall back to
+    # the next one.
+    MODES = ["incremental", "truncated", "full"]
+
+    def __init__(self, preprocessor, window_size, padded_window_size, hop_size):
+        self.preprocessor = preprocessor
+        self.window_size = window_size
+        self.padded_window_size = padded_window_size
+        self.hop_size = hop_size
+
+        self.padded_buffer = torch.zeros(padded_window_size)
+
+        self.mode = "full"
+        try:
+            self._probe()
+        except (RuntimeError, ValueError) as e:
+            print("Error in WakeFeatureCache: Could not probe the preprocessor, "
+                  "falling back to computing the full features - ", e)
+            return
+
+        for mode in self.MODES:
+            self.mode = mode
+            if mode == "full" or self._matches_full():
+                break
+
+        self.reset()
+
+    def reset(self):
+        self._cache = None
+        self._cache_start = None
+
+    def __call__(self, window, peak, total_samples):
+        # `window` are the raw samples of the window, `peak` their peak amplitude
+        # and `total_samples` the number of samples recorded up to the end of
+        # the window, which tells us how far the window has moved
+        if self.mode == "incremental":
+            return self._incremental(window, peak, total_samples)
+
+        normalize_peak(window, out=self.padded_buffer[:self.window_size], peak=peak)
+        padded = self.padded_buffer.unsqueeze(0)
+
+        if self.mode == "truncated":
+            features = self.preprocessor(padded[:, :self._truncated_size])
+            return torch.cat((self._frames(features, 0, self._zero_start),
+                self._zero_block), self._time_dim)
+
+        return self.preprocessor(padded)
+
+    def _frames(self, features, start, end):
+        return features.narrow(self._time_dim, start, end - start)
+
+    def _probe(self):
+        window, padded = self.window_size, self.padded_window_size
+
+        self._time_dim, frame_hop, before, after = probe_frames(
+            self.preprocessor, padded, self.hop_size)
+        self._frame_hop = frame_hop
+        zeros = self.preprocessor(torch.zeros(1, padded))
+        num_frames = zeros.shape[self._time_dim]
+        self._before, self._after = before, after
+
+        # Frames before `_head_end` reach over the start of the window and frames
+        # after `_tail_start` reach over its end into the zero padding. The ones
+        # after `_zero_start` only cover zeros, so they never change.
+        self._head_end = _ceil_div(before, frame_hop)
+        self._tail_start = max(_ceil_div(window - after, frame_hop), 0)
+        self._zero_start = min(_ceil_div(window + before, frame_hop), num_frames)
+        self._zero_block = self._frames(zeros, self._zero_start, num_frames).clone()
+        self._truncated_size = min(padded, window + before + after + frame_hop)
+
+        self._tail_offset = max(self._tail_start * frame_hop - before, 0) //\
+            frame_hop * frame_hop
+        self._tail_buffer = torch.zeros(
+            window - self._tail_offset + before + after + frame_hop)
+
+        if self._head_end > self._tail_start or window % frame_hop or\
+                padded - window < before + after + frame_hop:
+            raise ValueError("The window is too short for the receptive field")
+
+        # Check if the features are homogeneous in the gain
+        self._gain_exponent = probe_gain_exponent(self.preprocessor, window)
+
+    def _matches_full(self):
+        if self.mode == "incremental" and self._gain_exponent is None:
+            return False
+
+        generator = torch.Generator().manual_seed(0)
+        num_hops = 6
+        stream = torch.rand(self.window_size + self.hop_size * num_hops,
+            generator=generator) * 2 - 1
+        stream *= torch.linspace(.1, 1, stream.shape[0])
+
+        self.reset()
+        matches = True
+        # Skip a hop half way through, to check that we recover from gaps
+        for hop in [0, 1, 2, 4, 5, 6]:
+            total_samples = self.window_size + hop * self.hop_size
+            window = stream[total_samples - self.window_size:total_samples]
+            peak = window.abs().max()
+
+            got = self(window, peak, total_samples)
+            expected = self.preprocessor(torch.cat((normalize_peak(window.clone()),
+                torch.zeros(self.padded_window_size - self.window_size))).unsqueeze(0))
+
+            if got.shape != expected.shape or not torch.allclose(got, expected,
+                    rtol=1e-4, atol=1e-5 * float(expected.abs().max())):
+                matches = False
+                break
+
+        self.reset()
+        return matches
+
+    def _segment_frames(self, samples, offset, start, end):
+        # Computes frames `start` to `end` of the window from the given samples,
+        # which start at sample `offset` of the window
+        frames_offset = offset // self._frame_hop
+        return self._frames(self.preprocessor(samples.unsqueeze(0)),
+            start - frames_offset, end - frames_offset)
+
+    def _incremental(self, window, peak, total_samples):
+        frame_hop = self._frame_hop
+        before, after = self._before, self._after
+
+        # The absolute index of the first frame of the window
+        window_start = (total_samples - self.window_size) // frame_hop
+        first, last = window_start + self._head_end, window_start + self._tail_start
+
+        # Drop the frames that have moved out of the window, or the whole cache if
+        # the window has jumped past it
+        if self._cache is not None:
+            cache_end = self._cache_start + self._cache.shape[self._time_dim]
+            if self._cache_start > first or cache_end < first:
+                self.reset()
+            else:
+                self._cache = self._frames(self._cache, first - self._cache_start,
+                    min(cache_end, last) - self._cache_start)
+                self._cache_start = first
+
+        # Compute the frames that depend on new samples
+        missing = first if self._cache is None else\
+            self._cache_start + self._cache.shape[self._time_dim]
+        if missing < last:
+            offset = ((missing - window_start) * frame_hop - before) //\
+                frame_hop * frame_hop
+            end = (last - 1 - window_start) * frame_hop + after + 1
+            new_frames = self._segment_frames(window[offset:end], offset,
+                missing - window_start, last - window_start)
+
+            self._cache = new_frames if self._cache is None else\
+                torch.cat((self._cache, new_frames), self._time_dim)
+            self._cache_start = first if self._cache_start is None else self._cache_start
+
+        # The frames at the edges of the window
+        head = self._segment_frames(
+            window[:self._head_end * frame_hop + after + frame_hop], 0, 0, self._head_end)
+
+        tail_samples = self.window_size - self._tail_offset
+        self._tail_buffer[:tail_samples] = window[self._tail_offset:]
+        tail = self._segment_frames(self._tail_buffer, self._tail_offset,
+            self._tail_start, self._zero_start)
+
+        scale = peak_scale(peak) ** self._gain_exponent
+        return torch.cat((torch.cat((head, self._cache, tail), self._time_dim) * scale,
+            self._zero_block), self._time_dim)